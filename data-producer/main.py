@@ -5,14 +5,18 @@ import os
 import logging
 import json
 import time
-from typing import List, Dict, Any
+import uuid
+import secrets
+from typing import List, Optional, Dict, Any, Literal
 from datetime import datetime
 
 import aiohttp
 import pika
-from fastapi import FastAPI, BackgroundTasks
-from pydantic import BaseModel
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Header
+from fastapi.responses import FileResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
+from profiler import run_profile, ProfileInProgress
 
 # Load environment variables
 load_dotenv()
@@ -31,7 +35,52 @@ RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
 RABBITMQ_USER = os.getenv('RABBITMQ_USER', 'admin')
 RABBITMQ_PASS = os.getenv('RABBITMQ_PASS', 'admin123')
+RABBITMQ_HEARTBEAT = int(os.getenv('RABBITMQ_HEARTBEAT', '60'))
 QUEUE_NAME = os.getenv('QUEUE_NAME', 'stock_data_queue')
+ALERT_RULES_QUEUE = os.getenv('ALERT_RULES_QUEUE', 'alert_rules_queue')
+FETCH_INTERVAL = float(os.getenv('FETCH_INTERVAL', '60'))
+MAX_FETCH_INTERVAL = float(os.getenv('MAX_FETCH_INTERVAL', '600'))
+QUEUE_HIGH_WATERMARK = int(os.getenv('QUEUE_HIGH_WATERMARK', '1000'))
+QUEUE_LOW_WATERMARK = int(os.getenv('QUEUE_LOW_WATERMARK', '100'))
+QUEUE_SHED_WATERMARK = int(os.getenv('QUEUE_SHED_WATERMARK', '5000'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_DURATION = float(os.getenv('PROFILE_DURATION', '30'))
+PROFILE_MAX_DURATION = float(os.getenv('PROFILE_MAX_DURATION', '120'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+
+def parse_pairs(value: str) -> Dict[str, str]:
+    """Parse 'KEY:VALUE,KEY:VALUE' settings such as SYMBOL_TIERS and TIER_FETCH_INTERVALS"""
+    pairs = {}
+    for item in value.split(','):
+        if item.strip():
+            key, _, setting = item.partition(':')
+            pairs[key.strip()] = setting.strip()
+    return pairs
+
+# Symbol tiers: tier 1 is what we trade on, higher tiers are fetched less often,
+# go to their own queues and are the first to be shed under backpressure
+SYMBOL_TIERS = {symbol: int(tier) for symbol, tier in parse_pairs(os.getenv('SYMBOL_TIERS', '')).items()}
+DEFAULT_SYMBOL_TIER = int(os.getenv('DEFAULT_SYMBOL_TIER', '1'))
+TIER_FETCH_INTERVALS = {
+    int(tier): float(interval) for tier, interval in parse_pairs(os.getenv('TIER_FETCH_INTERVALS', '')).items()
+}
+
+def symbol_tier(symbol: str) -> int:
+    return SYMBOL_TIERS.get(symbol, DEFAULT_SYMBOL_TIER)
+
+def tier_queue_name(tier: int) -> str:
+    """Tier 1 keeps the original queue, so untiered setups are unchanged"""
+    return QUEUE_NAME if tier == 1 else f"{QUEUE_NAME}_tier{tier}"
+
+def group_symbols_by_tier(symbols: List[str]) -> Dict[int, List[str]]:
+    tiers: Dict[int, List[str]] = {}
+    for symbol in symbols:
+        tiers.setdefault(symbol_tier(symbol), []).append(symbol)
+    return tiers
+
+TIER_SYMBOLS = group_symbols_by_tier(STOCK_SYMBOLS)
+TIERS = sorted(TIER_SYMBOLS)
 
 # FastAPI app
 app = FastAPI(title="Financial Data Producer", version="2.0.0")
@@ -48,11 +97,66 @@ class StockData(BaseModel):
     market_cap: float
     timestamp: datetime
 
+class AlertRuleRequest(BaseModel):
+    # Limits match the alert_rules columns
+    symbol: str = Field(min_length=1, max_length=10)
+    rule_type: Literal['price_above', 'price_below', 'change_above', 'change_below', 'volume_spike']
+    threshold: float = Field(allow_inf_nan=False)
+    cooldown_seconds: int = Field(300, ge=0, le=2 ** 31 - 1)
+
+class BackpressureMonitor:
+    """Widens a tier's poll interval, and sheds tiers above 1, while its queue backs up"""
+    
+    def __init__(self, tier: int = 1):
+        self.tier = tier
+        self.base_interval = TIER_FETCH_INTERVALS.get(tier, FETCH_INTERVAL)
+        self.poll_interval = self.base_interval
+        self.queue_depth = None
+        self.consumer_count = None
+        self.shedding = False
+    
+    def update(self, queue_depth: int, consumer_count: int):
+        """Adapt to the ready-message count of the tier's queue"""
+        self.queue_depth = queue_depth
+        self.consumer_count = consumer_count
+        previous_interval, previous_shedding = self.poll_interval, self.shedding
+        
+        # Hysteresis between the low and high watermarks avoids oscillating
+        if queue_depth >= QUEUE_HIGH_WATERMARK:
+            self.poll_interval = min(self.poll_interval * 2, max(MAX_FETCH_INTERVAL, self.base_interval))
+        elif queue_depth <= QUEUE_LOW_WATERMARK:
+            self.poll_interval = max(self.poll_interval / 2, self.base_interval)
+        
+        # Tier 1 is never shed
+        if queue_depth >= QUEUE_SHED_WATERMARK and self.tier > 1:
+            self.shedding = True
+        elif queue_depth <= QUEUE_LOW_WATERMARK:
+            self.shedding = False
+        
+        if self.poll_interval != previous_interval or self.shedding != previous_shedding:
+            logging.warning(
+                f"Tier {self.tier} queue depth {queue_depth}: poll interval {self.poll_interval:.0f}s, "
+                f"shedding: {self.shedding}"
+            )
+    
+    def active_symbols(self, symbols: List[str]) -> List[str]:
+        """Symbols to fetch this cycle"""
+        return [] if self.shedding else symbols
+    
+    def state(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "consumer_count": self.consumer_count,
+            "poll_interval": self.poll_interval,
+            "shedding": self.shedding
+        }
+
 class DataProducer:
     def __init__(self):
         self.session = None
         self.connection = None
         self.channel = None
+        self.backpressure = {tier: BackpressureMonitor(tier) for tier in TIERS}
         
     def setup_rabbitmq(self):
         """Setup RabbitMQ connection and channel"""
@@ -62,21 +166,71 @@ class DataProducer:
                 host=RABBITMQ_HOST,
                 port=RABBITMQ_PORT,
                 credentials=credentials,
-                heartbeat=600,
+                heartbeat=RABBITMQ_HEARTBEAT,
                 blocked_connection_timeout=300
             )
             
             self.connection = pika.BlockingConnection(parameters)
             self.channel = self.connection.channel()
             
-            # Declare queue
-            self.channel.queue_declare(queue=QUEUE_NAME, durable=True)
-            logging.info(f"Connected to RabbitMQ and declared queue: {QUEUE_NAME}")
+            # Declare one queue per symbol tier
+            for tier in TIERS:
+                self.channel.queue_declare(queue=tier_queue_name(tier), durable=True)
+            self.channel.queue_declare(queue=ALERT_RULES_QUEUE, durable=True)
+            logging.info(
+                f"Connected to RabbitMQ and declared queues: "
+                f"{', '.join(tier_queue_name(tier) for tier in TIERS)}"
+            )
             
         except Exception as e:
             logging.error(f"Failed to connect to RabbitMQ: {e}")
             raise
     
+    def reset_rabbitmq(self):
+        """Drop a broken connection so the next publish reconnects"""
+        connection, self.connection, self.channel = self.connection, None, None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except Exception:
+                pass
+    
+    def ensure_rabbitmq(self):
+        """Reconnect if the connection or channel was closed"""
+        if self.connection is None or not self.connection.is_open or not self.channel.is_open:
+            self.reset_rabbitmq()
+            self.setup_rabbitmq()
+    
+    def publish(self, routing_key: str, body: str):
+        """Publish a persistent message, reconnecting once if the connection or channel was lost"""
+        for attempt in (1, 2):
+            try:
+                self.ensure_rabbitmq()
+                self.channel.basic_publish(
+                    exchange='',
+                    routing_key=routing_key,
+                    body=body,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                    )
+                )
+                return
+            except pika.exceptions.AMQPError as e:
+                if attempt == 2:
+                    raise
+                logging.warning(f"RabbitMQ publish failed, reconnecting: {e}")
+                self.reset_rabbitmq()
+    
+    def process_rabbitmq_events(self):
+        """Answer heartbeats; a BlockingConnection only does so while it is called into"""
+        if self.connection is None or not self.connection.is_open:
+            return
+        try:
+            self.connection.process_data_events(0)
+        except pika.exceptions.AMQPError as e:
+            logging.warning(f"RabbitMQ connection lost, reconnecting on next publish: {e}")
+            self.reset_rabbitmq()
+    
     async def setup_session(self):
         """Setup aiohttp session"""
         self.session = aiohttp.ClientSession()
@@ -107,33 +261,43 @@ class DataProducer:
         return None
     
     def publish_to_rabbitmq(self, data: Dict[str, Any]):
-        """Publish data to RabbitMQ queue"""
+        """Publish data to the queue of the symbol's tier"""
         try:
-            message = json.dumps(data)
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=QUEUE_NAME,
-                body=message,
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # make message persistent
-                )
-            )
+            self.publish(tier_queue_name(symbol_tier(data['symbol'])), json.dumps(data))
             logging.info(f"Published data for {data['symbol']}: {data['price']}")
         except Exception as e:
             logging.error(f"Failed to publish to RabbitMQ: {e}")
     
-    async def fetch_and_publish_all(self):
-        """Fetch data for all symbols and publish to RabbitMQ"""
+    def publish_rule_command(self, command: Dict[str, Any]):
+        """Publish an alert rule command for the stream processor"""
+        self.publish(ALERT_RULES_QUEUE, json.dumps(command))
+    
+    def check_backpressure(self, tier: int):
+        """Read a tier queue's depth with a passive declare"""
+        try:
+            self.ensure_rabbitmq()
+            result = self.channel.queue_declare(queue=tier_queue_name(tier), durable=True, passive=True)
+            self.backpressure[tier].update(result.method.message_count, result.method.consumer_count)
+        except Exception as e:
+            logging.error(f"Failed to check tier {tier} queue depth: {e}")
+            if isinstance(e, pika.exceptions.AMQPError):
+                self.reset_rabbitmq()
+    
+    async def fetch_and_publish_tier(self, tier: int):
+        """Fetch data for one tier's symbols and publish to its queue"""
         if not self.session:
             await self.setup_session()
         
-        for symbol in STOCK_SYMBOLS:
+        self.check_backpressure(tier)
+        for symbol in self.backpressure[tier].active_symbols(TIER_SYMBOLS[tier]):
             data = await self.fetch_stock_data(symbol)
             if data:
                 self.publish_to_rabbitmq(data)
-        
-        # Rate limiting
-        await asyncio.sleep(60)
+    
+    async def fetch_and_publish_all(self):
+        """Fetch data for all symbols once and publish to RabbitMQ"""
+        for tier in TIERS:
+            await self.fetch_and_publish_tier(tier)
     
     async def cleanup(self):
         """Cleanup resources"""
@@ -168,8 +332,10 @@ async def health_check():
     """Detailed health check"""
     return {
         "status": "healthy",
-        "rabbitmq_connected": producer.connection is not None,
+        "rabbitmq_connected": producer.connection is not None and producer.connection.is_open,
         "symbols": STOCK_SYMBOLS,
+        "tiers": {f"tier{tier}": TIER_SYMBOLS[tier] for tier in TIERS},
+        "backpressure": {f"tier{tier}": monitor.state() for tier, monitor in producer.backpressure.items()},
         "timestamp": datetime.now().isoformat()
     }
 
@@ -182,19 +348,103 @@ async def fetch_data(background_tasks: BackgroundTasks):
 @app.get("/symbols")
 async def get_symbols():
     """Get configured stock symbols"""
-    return {"symbols": STOCK_SYMBOLS}
+    return {"symbols": STOCK_SYMBOLS, "tiers": {f"tier{tier}": TIER_SYMBOLS[tier] for tier in TIERS}}
+
+def build_rule_payload(rule: AlertRuleRequest) -> Dict[str, Any]:
+    """Assign an id to a rule request"""
+    payload = rule.model_dump()
+    payload['rule_id'] = uuid.uuid4().hex
+    payload['symbol'] = rule.symbol.upper()
+    return payload
+
+@app.post("/alerts/rules")
+async def add_alert_rule(rule: AlertRuleRequest):
+    """Register a price alert rule"""
+    payload = build_rule_payload(rule)
+    try:
+        producer.publish_rule_command({"action": "add", "rule": payload})
+    except Exception as e:
+        logging.error(f"Failed to publish alert rule: {e}")
+        raise HTTPException(status_code=503, detail="Alert rule could not be queued")
+    return {"message": "Alert rule registered", "rule": payload}
+
+@app.post("/alerts/rules/bulk")
+async def add_alert_rules(rules: List[AlertRuleRequest]):
+    """Register many price alert rules in one command"""
+    payloads = [build_rule_payload(rule) for rule in rules]
+    try:
+        producer.publish_rule_command({"action": "bulk_add", "rules": payloads})
+    except Exception as e:
+        logging.error(f"Failed to publish alert rules: {e}")
+        raise HTTPException(status_code=503, detail="Alert rules could not be queued")
+    return {"message": f"{len(payloads)} alert rules registered", "rule_ids": [p['rule_id'] for p in payloads]}
+
+@app.delete("/alerts/rules/{rule_id}")
+async def remove_alert_rule(rule_id: str):
+    """Remove a price alert rule"""
+    try:
+        producer.publish_rule_command({"action": "remove", "rule_id": rule_id})
+    except Exception as e:
+        logging.error(f"Failed to publish alert rule removal: {e}")
+        raise HTTPException(status_code=503, detail="Alert rule removal could not be queued")
+    return {"message": "Alert rule removal queued", "rule_id": rule_id}
+
+def check_profile_token(authorization: Optional[str]):
+    """Profiling is off without PROFILE_TOKEN and needs 'Authorization: Bearer <token>'"""
+    if not PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not secrets.compare_digest(authorization or '', f"Bearer {PROFILE_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid profile token")
+
+@app.post("/admin/profile")
+async def profile(duration: float = PROFILE_DURATION, memory: bool = False,
+                  authorization: Optional[str] = Header(None)):
+    """Sample the producer's stacks (and, with memory=true, allocations) against live traffic"""
+    check_profile_token(authorization)
+    if not 0 < duration <= PROFILE_MAX_DURATION:
+        raise HTTPException(status_code=400, detail=f"duration must be between 0 and {PROFILE_MAX_DURATION} seconds")
+    try:
+        # The sampler runs in a worker thread so the event loop keeps serving while it is watched
+        result = await asyncio.to_thread(run_profile, PROFILE_DIR, duration, PROFILE_INTERVAL, memory)
+    except ProfileInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    result['downloads'] = [
+        f"/admin/profile/{os.path.basename(result[key])}" for key in ('collapsed', 'memory') if key in result
+    ]
+    return result
+
+@app.get("/admin/profile/{name}")
+async def download_profile(name: str, authorization: Optional[str] = Header(None)):
+    """Download a collapsed-stack file or memory report written by /admin/profile"""
+    check_profile_token(authorization)
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type='text/plain', filename=os.path.basename(path))
 
 # Background task for continuous data fetching
-async def continuous_data_fetch():
-    """Background task that continuously fetches and publishes data"""
+async def continuous_data_fetch(tier: int):
+    """Background task that fetches and publishes one tier at its own cadence"""
     while True:
         try:
-            await producer.fetch_and_publish_all()
+            await producer.fetch_and_publish_tier(tier)
+            
+            # Rate limiting
+            await asyncio.sleep(producer.backpressure[tier].poll_interval)
         except Exception as e:
-            logging.error(f"Error in continuous data fetch: {e}")
+            logging.error(f"Error in continuous data fetch for tier {tier}: {e}")
             await asyncio.sleep(10)
 
+async def rabbitmq_heartbeat():
+    """Serve the connection's heartbeats while tiers sleep through long poll intervals"""
+    while True:
+        await asyncio.sleep(max(RABBITMQ_HEARTBEAT / 4, 1))
+        producer.process_rabbitmq_events()
+
 @app.on_event("startup")
 async def start_background_tasks():
     """Start background tasks"""
-    asyncio.create_task(continuous_data_fetch()) 
\ No newline at end of file
+    for tier in TIERS:
+        asyncio.create_task(continuous_data_fetch(tier))
+    asyncio.create_task(rabbitmq_heartbeat()) 
\ No newline at end of file
@@ -1,5 +1,4 @@
 from logging.config import fileConfig
-import os
 from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 from alembic import context
@@ -9,7 +8,8 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Import your models
-from models import Base, StockData, StockAnalytics
+from models import Base, Symbol, StockData, StockAnalytics, AnalyticsBackfillProgress, PriceAlertRule
+from models import DB_DRIVER, get_database_url
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -29,16 +29,6 @@ target_metadata = Base.metadata
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
-def get_database_url():
-    """Get database URL from environment variables"""
-    host = os.getenv('POSTGRES_HOST', 'postgres')
-    port = os.getenv('POSTGRES_PORT', '5432')
-    database = os.getenv('POSTGRES_DB', 'fintech_data')
-    user = os.getenv('POSTGRES_USER', 'fintech_user')
-    password = os.getenv('POSTGRES_PASSWORD', 'fintech_pass')
-    
-    return f"postgresql://{user}:{password}@{host}:{port}/{database}"
-
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
 
@@ -51,7 +41,7 @@ def run_migrations_offline() -> None:
     script output.
 
     """
-    url = get_database_url()
+    url = get_database_url(DB_DRIVER)
     context.configure(
         url=url,
         target_metadata=target_metadata,
@@ -71,7 +61,7 @@ def run_migrations_online() -> None:
 
     """
     # Override the sqlalchemy.url in the config
-    config.set_main_option("sqlalchemy.url", get_database_url())
+    config.set_main_option("sqlalchemy.url", get_database_url(DB_DRIVER))
     
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
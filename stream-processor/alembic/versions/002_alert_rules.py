@@ -0,0 +1,37 @@
+"""Add alert rules table
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-02-01 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Create alert_rules table
+    op.create_table('alert_rules',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('symbol', sa.String(length=10), nullable=False),
+        sa.Column('rule_type', sa.String(length=20), nullable=False),
+        sa.Column('threshold', sa.Float(), nullable=False),
+        sa.Column('cooldown_seconds', sa.Integer(), nullable=False, server_default='300'),
+        sa.Column('enabled', sa.Boolean(), nullable=False, server_default=sa.true()),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    
+    op.create_index(op.f('ix_alert_rules_symbol'), 'alert_rules', ['symbol'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_alert_rules_symbol'), table_name='alert_rules')
+    op.drop_table('alert_rules')
@@ -0,0 +1,179 @@
+"""Compact stock_data layout
+
+Moves company name and exchange into a symbols dimension table referenced by
+a smallint, stores prices as float8 instead of numeric, and replaces the
+overlapping symbol/timestamp B-trees with a (symbol_id, timestamp) B-tree and
+a BRIN index on timestamp.
+
+The data is copied into a freshly created table ordered by timestamp (which
+is what makes the BRIN index selective on historical rows) rather than
+rewritten in place, so the old table is dropped without leaving dead tuples.
+Table size and copy throughput are logged before and after; run
+measure_storage.py before and after the upgrade for comparable insert rates.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2024-03-01 00:00:00.000000
+
+"""
+import logging
+import time
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# Columns converted from numeric to float8
+PRICE_COLUMNS = [
+    'price', 'change_percentage', 'market_cap',
+    'open_price', 'high_price', 'low_price', 'previous_close'
+]
+
+
+def measure_table(label: str):
+    """Log size, row count and average row width of stock_data"""
+    if context.is_offline_mode():
+        return None
+
+    row = op.get_bind().execute(sa.text(
+        "SELECT pg_total_relation_size('stock_data') AS total_bytes, "
+        "pg_relation_size('stock_data') AS heap_bytes, "
+        "pg_indexes_size('stock_data') AS index_bytes, "
+        "(SELECT count(*) FROM stock_data) AS row_count, "
+        "(SELECT coalesce(avg(pg_column_size(t.*)), 0) FROM stock_data t) AS avg_row_bytes"
+    )).one()
+    logger.info(
+        f"stock_data {label}: total={row.total_bytes} bytes, heap={row.heap_bytes} bytes, "
+        f"indexes={row.index_bytes} bytes, rows={row.row_count}, avg_row={float(row.avg_row_bytes):.1f} bytes"
+    )
+    return row
+
+
+def upgrade() -> None:
+    measure_table('before')
+
+    # Symbol dimension table, seeded with the latest name/exchange seen per symbol
+    op.create_table('symbols',
+        sa.Column('id', sa.SmallInteger(), nullable=False),
+        sa.Column('symbol', sa.String(length=10), nullable=False),
+        sa.Column('company_name', sa.String(length=100), nullable=True),
+        sa.Column('exchange', sa.String(length=20), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('symbol', name='uq_symbols_symbol')
+    )
+    op.execute(
+        "INSERT INTO symbols (symbol, company_name, exchange) "
+        "SELECT DISTINCT ON (symbol) symbol, company_name, exchange "
+        "FROM stock_data ORDER BY symbol, timestamp DESC"
+    )
+
+    # 8-byte columns first, then 4 and 2 byte ones, to avoid alignment padding
+    op.create_table('stock_data_compact',
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.Column('price', sa.Double(), nullable=False),
+        sa.Column('change_percentage', sa.Double(), nullable=True),
+        sa.Column('market_cap', sa.Double(), nullable=True),
+        sa.Column('open_price', sa.Double(), nullable=True),
+        sa.Column('high_price', sa.Double(), nullable=True),
+        sa.Column('low_price', sa.Double(), nullable=True),
+        sa.Column('previous_close', sa.Double(), nullable=True),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('volume', sa.Integer(), nullable=True),
+        sa.Column('symbol_id', sa.SmallInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.ForeignKeyConstraint(['symbol_id'], ['symbols.id'], name='fk_stock_data_symbol_id')
+    )
+
+    # Data migration
+    started = time.monotonic()
+    price_columns = ', '.join(PRICE_COLUMNS)
+    price_values = ', '.join(f"d.{column}::float8" for column in PRICE_COLUMNS)
+    op.execute(
+        f"INSERT INTO stock_data_compact (id, symbol_id, timestamp, processed_at, volume, {price_columns}) "
+        f"SELECT d.id, s.id, d.timestamp, d.processed_at, d.volume, {price_values} "
+        f"FROM stock_data d JOIN symbols s ON s.symbol = d.symbol "
+        f"ORDER BY d.timestamp, d.id"
+    )
+    if not context.is_offline_mode():
+        copied = op.get_bind().execute(sa.text("SELECT count(*) FROM stock_data_compact")).scalar()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Copied {copied} rows in {elapsed:.2f}s ({copied / elapsed:.0f} rows/s)")
+
+    op.drop_table('stock_data')
+    op.rename_table('stock_data_compact', 'stock_data')
+    op.execute("ALTER SEQUENCE stock_data_compact_id_seq RENAME TO stock_data_id_seq")
+    op.execute("ALTER INDEX stock_data_compact_pkey RENAME TO stock_data_pkey")
+    op.execute(
+        "SELECT setval('stock_data_id_seq', coalesce(max(id), 1), max(id) IS NOT NULL) FROM stock_data"
+    )
+
+    op.create_index('idx_stock_data_symbol_id_timestamp', 'stock_data', ['symbol_id', 'timestamp'], unique=False)
+    op.create_index('brin_stock_data_timestamp', 'stock_data', ['timestamp'], unique=False, postgresql_using='brin')
+
+    # Denormalized view for BI tools that expect the symbol/name/exchange columns
+    op.execute(
+        "CREATE VIEW stock_data_enriched AS "
+        "SELECT d.*, s.symbol, s.company_name, s.exchange "
+        "FROM stock_data d JOIN symbols s ON s.id = d.symbol_id"
+    )
+
+    if not context.is_offline_mode():
+        op.execute("ANALYZE stock_data")
+    measure_table('after')
+
+
+def downgrade() -> None:
+    measure_table('before downgrade')
+
+    op.execute("DROP VIEW IF EXISTS stock_data_enriched")
+
+    op.create_table('stock_data_wide',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('symbol', sa.String(length=10), nullable=False),
+        sa.Column('price', sa.Numeric(precision=10, scale=2), nullable=False),
+        sa.Column('change_percentage', sa.Numeric(precision=5, scale=2), nullable=True),
+        sa.Column('volume', sa.Integer(), nullable=True),
+        sa.Column('market_cap', sa.Numeric(precision=20, scale=2), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.Column('open_price', sa.Numeric(precision=10, scale=2), nullable=True),
+        sa.Column('high_price', sa.Numeric(precision=10, scale=2), nullable=True),
+        sa.Column('low_price', sa.Numeric(precision=10, scale=2), nullable=True),
+        sa.Column('previous_close', sa.Numeric(precision=10, scale=2), nullable=True),
+        sa.Column('exchange', sa.String(length=20), nullable=True),
+        sa.Column('company_name', sa.String(length=100), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    price_columns = ', '.join(PRICE_COLUMNS)
+    price_values = ', '.join(f"d.{column}" for column in PRICE_COLUMNS)
+    op.execute(
+        f"INSERT INTO stock_data_wide (id, symbol, timestamp, processed_at, volume, exchange, company_name, {price_columns}) "
+        f"SELECT d.id, s.symbol, d.timestamp, d.processed_at, d.volume, s.exchange, s.company_name, {price_values} "
+        f"FROM stock_data d JOIN symbols s ON s.id = d.symbol_id "
+        f"ORDER BY d.id"
+    )
+
+    op.drop_table('stock_data')
+    op.drop_table('symbols')
+    op.rename_table('stock_data_wide', 'stock_data')
+    op.execute("ALTER SEQUENCE stock_data_wide_id_seq RENAME TO stock_data_id_seq")
+    op.execute("ALTER INDEX stock_data_wide_pkey RENAME TO stock_data_pkey")
+    op.execute(
+        "SELECT setval('stock_data_id_seq', coalesce(max(id), 1), max(id) IS NOT NULL) FROM stock_data"
+    )
+
+    op.create_index(op.f('ix_stock_data_symbol'), 'stock_data', ['symbol'], unique=False)
+    op.create_index(op.f('ix_stock_data_timestamp'), 'stock_data', ['timestamp'], unique=False)
+    op.create_index('idx_stock_data_symbol_timestamp', 'stock_data', ['symbol', 'timestamp'], unique=False)
+
+    measure_table('after downgrade')
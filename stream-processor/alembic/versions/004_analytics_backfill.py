@@ -0,0 +1,56 @@
+"""Analytics upserts and backfill progress
+
+Makes (symbol, date) unique in stock_analytics so daily analytics can be
+upserted, widens total_volume to bigint and percent_change to numeric(10,2)
+(daily moves of 1000% and more are real for penny stocks), and adds the
+progress table used by backfill_analytics.py to resume after an interruption.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2024-04-01 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Keep only the newest row of any duplicated (symbol, date) pair
+    op.execute(
+        "DELETE FROM stock_analytics a USING stock_analytics b "
+        "WHERE a.symbol = b.symbol AND a.date = b.date AND a.id < b.id"
+    )
+    op.drop_index('idx_stock_analytics_symbol_date', table_name='stock_analytics')
+    op.create_unique_constraint('uq_stock_analytics_symbol_date', 'stock_analytics', ['symbol', 'date'])
+    op.alter_column('stock_analytics', 'total_volume', type_=sa.BigInteger(), existing_type=sa.Integer())
+    op.alter_column('stock_analytics', 'percent_change',
+                    type_=sa.Numeric(precision=10, scale=2),
+                    existing_type=sa.Numeric(precision=5, scale=2))
+    
+    op.create_table('analytics_backfill_progress',
+        sa.Column('chunk_start', sa.DateTime(), nullable=False),
+        sa.Column('chunk_end', sa.DateTime(), nullable=False),
+        sa.Column('rows_written', sa.Integer(), nullable=False),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('chunk_start', 'chunk_end')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('analytics_backfill_progress')
+    
+    # Clamp moves the old numeric(5,2) cannot hold
+    op.alter_column('stock_analytics', 'percent_change',
+                    type_=sa.Numeric(precision=5, scale=2),
+                    existing_type=sa.Numeric(precision=10, scale=2),
+                    postgresql_using='least(greatest(percent_change, -999.99), 999.99)')
+    op.alter_column('stock_analytics', 'total_volume', type_=sa.Integer(), existing_type=sa.BigInteger())
+    op.drop_constraint('uq_stock_analytics_symbol_date', 'stock_analytics', type_='unique')
+    op.create_index('idx_stock_analytics_symbol_date', 'stock_analytics', ['symbol', 'date'], unique=False)
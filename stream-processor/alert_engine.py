@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import bisect
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Dict, Any, Tuple
+
+# Rule type -> (metric, crossing direction)
+RULE_TYPES = {
+    'price_above': ('price', 'up'),
+    'price_below': ('price', 'down'),
+    'change_above': ('change_percentage', 'up'),
+    'change_below': ('change_percentage', 'down'),
+    'volume_spike': ('volume_ratio', 'up'),
+}
+
+# Limits of the alert_rules columns
+RULE_ID_MAX_LENGTH = 32
+SYMBOL_MAX_LENGTH = 10
+COOLDOWN_MAX_SECONDS = 2 ** 31 - 1
+
+# Quote timestamps are naive UTC; snapshots store them as seconds since this
+EPOCH = datetime(1970, 1, 1)
+
+class AlertRule:
+    """Price alert rule registered against a single symbol"""
+
+    def __init__(self, rule_id: str, symbol: str, rule_type: str, threshold: float,
+                 cooldown_seconds: int = 300):
+        if rule_type not in RULE_TYPES:
+            raise ValueError(f"Unknown alert rule type: {rule_type}")
+        if not isinstance(symbol, str) or not symbol.strip():
+            raise ValueError("Alert rule requires a symbol")
+        if len(symbol.strip()) > SYMBOL_MAX_LENGTH:
+            raise ValueError(f"Alert rule symbol is longer than {SYMBOL_MAX_LENGTH} characters")
+        if not str(rule_id) or len(str(rule_id)) > RULE_ID_MAX_LENGTH:
+            raise ValueError(f"Alert rule id must be 1 to {RULE_ID_MAX_LENGTH} characters")
+        try:
+            threshold = float(threshold)
+            cooldown_seconds = int(cooldown_seconds)
+        except (TypeError, ValueError):
+            raise ValueError("Alert rule threshold and cooldown must be numbers")
+        # NaN would break the sort order of ThresholdIndex
+        if not math.isfinite(threshold):
+            raise ValueError("Alert rule threshold must be finite")
+        if not 0 <= cooldown_seconds <= COOLDOWN_MAX_SECONDS:
+            raise ValueError(f"Alert rule cooldown must be between 0 and {COOLDOWN_MAX_SECONDS} seconds")
+
+        self.rule_id = str(rule_id)
+        self.symbol = symbol.strip().upper()
+        self.rule_type = rule_type
+        self.threshold = threshold
+        self.cooldown_seconds = cooldown_seconds
+
+    @property
+    def metric(self) -> str:
+        return RULE_TYPES[self.rule_type][0]
+
+    @property
+    def direction(self) -> str:
+        return RULE_TYPES[self.rule_type][1]
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'AlertRule':
+        """Build a rule from an API/queue payload"""
+        return cls(
+            rule_id=data['rule_id'],
+            symbol=data.get('symbol', ''),
+            rule_type=data.get('rule_type', ''),
+            threshold=data['threshold'],
+            cooldown_seconds=data.get('cooldown_seconds', 300)
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'rule_id': self.rule_id,
+            'symbol': self.symbol,
+            'rule_type': self.rule_type,
+            'threshold': self.threshold,
+            'cooldown_seconds': self.cooldown_seconds
+        }
+
+class ThresholdIndex:
+    """Sorted thresholds for one (symbol, metric, direction) triple.
+
+    Thresholds and rule ids are kept in parallel lists so that the rules
+    crossed between two observations can be sliced out with two bisects.
+    """
+
+    def __init__(self):
+        self.thresholds: List[float] = []
+        self.rule_ids: List[str] = []
+
+    def __len__(self):
+        return len(self.thresholds)
+
+    def add(self, threshold: float, rule_id: str):
+        position = bisect.bisect_right(self.thresholds, threshold)
+        self.thresholds.insert(position, threshold)
+        self.rule_ids.insert(position, rule_id)
+
+    def remove(self, threshold: float, rule_id: str) -> bool:
+        start = bisect.bisect_left(self.thresholds, threshold)
+        end = bisect.bisect_right(self.thresholds, threshold)
+        for position in range(start, end):
+            if self.rule_ids[position] == rule_id:
+                del self.thresholds[position]
+                del self.rule_ids[position]
+                return True
+        return False
+
+    def crossed_up(self, previous: float, current: float) -> List[str]:
+        """Rules with previous < threshold <= current"""
+        start = bisect.bisect_right(self.thresholds, previous)
+        end = bisect.bisect_right(self.thresholds, current)
+        return self.rule_ids[start:end]
+
+    def crossed_down(self, previous: float, current: float) -> List[str]:
+        """Rules with current <= threshold < previous"""
+        start = bisect.bisect_left(self.thresholds, current)
+        end = bisect.bisect_left(self.thresholds, previous)
+        return self.rule_ids[start:end]
+
+class AlertEngine:
+    """Evaluates alert rules against incoming quotes.
+
+    Only the rules whose threshold lies between the previous and the current
+    value of a metric are looked at, so the cost per tick depends on how many
+    thresholds were crossed rather than on how many rules are registered.
+    """
+
+    def __init__(self, debounce_seconds: float = 30.0, volume_ewma_alpha: float = 0.2):
+        self.debounce_seconds = debounce_seconds
+        self.volume_ewma_alpha = volume_ewma_alpha
+        self.rules: Dict[str, AlertRule] = {}
+        self.indexes: Dict[Tuple[str, str, str], ThresholdIndex] = {}
+        self.last_values: Dict[str, Dict[str, float]] = {}
+        self.volume_ewma: Dict[str, float] = {}
+        # Newest quote timestamp folded into each symbol's state; quotes are
+        # evaluated in order per symbol but not across symbols
+        self.high_water_marks: Dict[str, datetime] = {}
+        self.last_crossed: Dict[str, float] = {}
+        self.last_fired: Dict[str, float] = {}
+        self.suppressed_count = 0
+        self.lock = threading.Lock()
+
+    def add_rule(self, rule: AlertRule):
+        """Register or replace a rule"""
+        with self.lock:
+            self._remove_rule(rule.rule_id)
+            self.rules[rule.rule_id] = rule
+            key = (rule.symbol, rule.metric, rule.direction)
+            if key not in self.indexes:
+                self.indexes[key] = ThresholdIndex()
+            self.indexes[key].add(rule.threshold, rule.rule_id)
+
+    def load_rules(self, rules: List[AlertRule]):
+        """Register a batch of rules"""
+        for rule in rules:
+            self.add_rule(rule)
+        logging.info(f"Loaded {len(rules)} alert rules")
+
+    def remove_rule(self, rule_id: str) -> bool:
+        """Unregister a rule"""
+        with self.lock:
+            return self._remove_rule(rule_id)
+
+    def _remove_rule(self, rule_id: str) -> bool:
+        rule = self.rules.pop(rule_id, None)
+        if rule is None:
+            return False
+
+        key = (rule.symbol, rule.metric, rule.direction)
+        index = self.indexes.get(key)
+        if index is not None:
+            index.remove(rule.threshold, rule_id)
+            if not index:
+                del self.indexes[key]
+        self.last_crossed.pop(rule_id, None)
+        self.last_fired.pop(rule_id, None)
+        return True
+
+    def _metrics(self, symbol: str, data: Dict[str, Any]) -> Dict[str, float]:
+        metrics = {}
+        if data.get('price') is not None:
+            metrics['price'] = float(data['price'])
+        if data.get('change_percentage') is not None:
+            metrics['change_percentage'] = float(data['change_percentage'])
+
+        volume = data.get('volume')
+        if volume is not None:
+            volume = float(volume)
+            average = self.volume_ewma.get(symbol)
+            if average:
+                metrics['volume_ratio'] = volume / average
+                self.volume_ewma[symbol] = average + self.volume_ewma_alpha * (volume - average)
+            else:
+                self.volume_ewma[symbol] = volume
+
+        return metrics
+
+    def evaluate(self, data: Dict[str, Any], now: Optional[float] = None,
+                 fire: bool = True) -> List[Dict[str, Any]]:
+        """Update per-symbol state with a quote and return the alerts it fires.
+
+        With fire=False only the per-symbol state is updated, which is how
+        history is replayed after a restart.
+        """
+        symbol = (data.get('symbol') or '').upper()
+        if not symbol:
+            return []
+        now = time.time() if now is None else now
+
+        alerts = []
+        with self.lock:
+            timestamp = data.get('timestamp')
+            if isinstance(timestamp, datetime):
+                mark = self.high_water_marks.get(symbol)
+                if mark is None or timestamp > mark:
+                    self.high_water_marks[symbol] = timestamp
+
+            metrics = self._metrics(symbol, data)
+            previous_values = self.last_values.setdefault(symbol, {})
+
+            for metric, current in metrics.items():
+                previous = previous_values.get(metric)
+                previous_values[metric] = current
+                if not fire or previous is None or previous == current:
+                    continue
+
+                if current > previous:
+                    index = self.indexes.get((symbol, metric, 'up'))
+                    crossed = index.crossed_up(previous, current) if index else []
+                else:
+                    index = self.indexes.get((symbol, metric, 'down'))
+                    crossed = index.crossed_down(previous, current) if index else []
+
+                for rule_id in crossed:
+                    rule = self.rules[rule_id]
+                    if self._should_fire(rule, now):
+                        alerts.append(self._build_alert(rule, previous, current, data))
+
+        return alerts
+
+    def _should_fire(self, rule: AlertRule, now: float) -> bool:
+        # Debounce: a threshold crossed again shortly after its last crossing is flapping
+        last_crossed = self.last_crossed.get(rule.rule_id)
+        self.last_crossed[rule.rule_id] = now
+        if last_crossed is not None and now - last_crossed < self.debounce_seconds:
+            self.suppressed_count += 1
+            return False
+
+        # Cooldown: minimum time between two alerts of the same rule
+        last_fired = self.last_fired.get(rule.rule_id)
+        if last_fired is not None and now - last_fired < rule.cooldown_seconds:
+            self.suppressed_count += 1
+            return False
+
+        self.last_fired[rule.rule_id] = now
+        return True
+
+    def _build_alert(self, rule: AlertRule, previous: float, current: float,
+                     data: Dict[str, Any]) -> Dict[str, Any]:
+        timestamp = data.get('timestamp')
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.isoformat()
+
+        return {
+            'rule_id': rule.rule_id,
+            'symbol': rule.symbol,
+            'rule_type': rule.rule_type,
+            'threshold': rule.threshold,
+            'previous_value': previous,
+            'current_value': current,
+            'price': data.get('price'),
+            'quote_timestamp': timestamp,
+            'fired_at': datetime.utcnow().isoformat()
+        }
+    
+    def export_state(self) -> Dict[str, Any]:
+        """Per-symbol and per-rule state as columnar tables for snapshots"""
+        with self.lock:
+            symbols = sorted(set(self.last_values) | set(self.volume_ewma) | set(self.high_water_marks))
+            symbol_columns = {
+                metric: [self.last_values.get(symbol, {}).get(metric) for symbol in symbols]
+                for metric in ('price', 'change_percentage', 'volume_ratio')
+            }
+            symbol_columns['volume_ewma'] = [self.volume_ewma.get(symbol) for symbol in symbols]
+            symbol_columns['high_water_mark'] = [
+                (self.high_water_marks[symbol] - EPOCH).total_seconds() if symbol in self.high_water_marks else None
+                for symbol in symbols
+            ]
+            
+            rule_ids = sorted(set(self.last_crossed) | set(self.last_fired))
+            rule_columns = {
+                'last_crossed': [self.last_crossed.get(rule_id) for rule_id in rule_ids],
+                'last_fired': [self.last_fired.get(rule_id) for rule_id in rule_ids]
+            }
+        
+        return {
+            'alert_symbols': (symbols, symbol_columns),
+            'alert_rules': (rule_ids, rule_columns)
+        }
+    
+    def restore_state(self, tables: Dict[str, Any]):
+        """Load state produced by export_state"""
+        with self.lock:
+            symbols, columns = tables.get('alert_symbols', ([], {}))
+            missing = [None] * len(symbols)
+            for i, symbol in enumerate(symbols):
+                values = self.last_values.setdefault(symbol, {})
+                for metric in ('price', 'change_percentage', 'volume_ratio'):
+                    value = columns.get(metric, missing)[i]
+                    if value is not None:
+                        values[metric] = value
+                ewma = columns.get('volume_ewma', missing)[i]
+                if ewma is not None:
+                    self.volume_ewma[symbol] = ewma
+                mark = columns.get('high_water_mark', missing)[i]
+                if mark is not None:
+                    self.high_water_marks[symbol] = EPOCH + timedelta(seconds=mark)
+            
+            # Timers of rules that were removed meanwhile are dropped
+            rule_ids, columns = tables.get('alert_rules', ([], {}))
+            missing = [None] * len(rule_ids)
+            for i, rule_id in enumerate(rule_ids):
+                if rule_id not in self.rules:
+                    continue
+                for column, timers in (('last_crossed', self.last_crossed), ('last_fired', self.last_fired)):
+                    value = columns.get(column, missing)[i]
+                    if value is not None:
+                        timers[rule_id] = value
@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+"""asyncio stream processor, selected with PROCESSOR_MODE=async.
+
+Quotes are consumed with aio-pika and written through an asyncpg pool, so
+several batch commits can be in flight while the next quotes are decoded.
+Every symbol hashes onto one of ASYNC_LANES lanes; a lane batches its
+quotes and has at most one commit in flight, which keeps each symbol's
+rows in order, while up to ASYNC_MAX_INFLIGHT_COMMITS lanes commit at once.
+Each symbol tier is consumed on its own channel with a prefetch window
+proportional to its weight, so lower tiers cannot crowd out tier 1.
+While the database is down, lanes append their batches to the same local
+spool as the blocking mode. Alert rules, state snapshots and rule
+commands reuse the blocking processor's code.
+"""
+
+import os
+import json
+import asyncio
+import logging
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from typing import List, Optional, Dict, Any, Tuple
+
+import aio_pika
+import asyncpg
+from sqlalchemy.exc import DataError, IntegrityError
+from models import get_database_url
+from stages import decode_message, validate_stock_data, enrich_stock_data
+from tiers import tier_queue_name
+from stream_processor import (
+    StreamProcessor,
+    RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASS,
+    QUEUE_NAME, ALERT_RULES_QUEUE, ALERT_EXCHANGE, DB_RETRY_INTERVAL, BATCH_MAX_WAIT,
+    FLOW_MAX_PREFETCH, SPOOL_PREFETCH_COUNT, FLUSH_TICK,
+    QUEUE_DEPTH_POLL_INTERVAL, STATE_SNAPSHOT_INTERVAL, TIERS, TIER_WEIGHTS
+)
+
+ASYNC_LANES = int(os.getenv('ASYNC_LANES', '8'))
+ASYNC_MAX_INFLIGHT_COMMITS = int(os.getenv('ASYNC_MAX_INFLIGHT_COMMITS', '4'))
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', str(ASYNC_MAX_INFLIGHT_COMMITS + 1)))
+
+INSERT_STOCK_DATA = """
+    INSERT INTO stock_data (
+        symbol_id, price, change_percentage, volume, market_cap, timestamp,
+        processed_at, open_price, high_price, low_price, previous_close
+    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+"""
+
+SELECT_SYMBOL_ID = "SELECT id FROM symbols WHERE symbol = $1"
+
+# Only run after SELECT_SYMBOL_ID missed: even a conflicting INSERT takes a value from the id sequence
+INSERT_SYMBOL = """
+    INSERT INTO symbols (symbol, company_name, exchange) VALUES ($1, $2, $3)
+    ON CONFLICT (symbol) DO NOTHING
+    RETURNING id
+"""
+
+# Client-side errors meaning the database cannot take writes right now. Client-side
+# encoding errors (asyncpg's DataError) are InterfaceErrors too, but they are
+# also ValueErrors and mean a bad record; see is_db_unavailable().
+DB_UNAVAILABLE_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError
+)
+
+# SQLSTATE classes blaming the record itself: data exceptions and integrity
+# constraint violations. Every other server error (connection failures,
+# shutdowns, too many connections, cancelled statements, serialization
+# failures) clears up without changing the record.
+BAD_RECORD_SQLSTATE_CLASSES = ('22', '23')
+
+def is_db_unavailable(error: Exception) -> bool:
+    if isinstance(error, asyncpg.PostgresError):
+        return (error.sqlstate or '')[:2] not in BAD_RECORD_SQLSTATE_CLASSES
+    return isinstance(error, DB_UNAVAILABLE_ERRORS) and not isinstance(error, ValueError)
+
+class Lane:
+    """Quotes of the symbols hashed onto one lane, committed one batch at a time"""
+
+    def __init__(self, index: int):
+        self.index = index
+        # (tier, message, quote)
+        self.batch: List[Tuple[int, aio_pika.abc.AbstractIncomingMessage, Dict[str, Any]]] = []
+        self.batch_started = 0.0
+        self.commit: Optional[asyncio.Task] = None
+
+class AckTracker:
+    """Settle deliveries with one multiple-ack per contiguous run of finished tags.
+
+    Lanes finish out of delivery order, so a tag is only covered by a
+    multiple-ack once every earlier delivery has been acked or nacked.
+    Delivery tags restart when the channel is reopened after a reconnect,
+    so reset() then forgets the old deliveries (the broker redelivers
+    them) and late settlements of those are ignored.
+    """
+
+    def __init__(self):
+        # delivery tag -> (message, 'ack' | 'nack' | None while in flight)
+        self.pending: 'OrderedDict[int, Tuple[Any, Optional[str]]]' = OrderedDict()
+        self.lock = asyncio.Lock()
+
+    def track(self, message):
+        self.pending[message.delivery_tag] = (message, None)
+
+    def reset(self, *args):
+        """Forget in-flight deliveries of a closed channel, used as its reopen callback"""
+        if self.pending:
+            logging.warning(f"Channel reopened, {len(self.pending)} unacked deliveries will be redelivered")
+        self.pending = OrderedDict()
+
+    def _record(self, message, state: str) -> bool:
+        entry = self.pending.get(message.delivery_tag)
+        if entry is None or entry[0] is not message:
+            # Delivered on a channel that has since been reopened
+            return False
+        self.pending[message.delivery_tag] = (message, state)
+        return True
+
+    async def ack(self, messages):
+        for message in messages:
+            self._record(message, 'ack')
+        await self._advance()
+
+    async def nack(self, messages, requeue: bool):
+        async with self.lock:
+            for message in messages:
+                if self._record(message, 'nack'):
+                    try:
+                        await message.nack(requeue=requeue)
+                    except Exception as e:
+                        # The channel closed; the broker redelivers the message anyway
+                        logging.error(f"Failed to nack delivery {message.delivery_tag}: {e}")
+        await self._advance()
+
+    async def _advance(self):
+        # Serialised so multiple-acks are sent in increasing tag order
+        async with self.lock:
+            last = None
+            while self.pending:
+                message, state = next(iter(self.pending.values()))
+                if state is None:
+                    break
+                self.pending.popitem(last=False)
+                if state == 'ack':
+                    last = message
+            if last is not None:
+                try:
+                    await last.ack(multiple=True)
+                except Exception as e:
+                    logging.error(f"Failed to ack deliveries up to {last.delivery_tag}: {e}")
+
+class AsyncStreamProcessor(StreamProcessor):
+    def __init__(self):
+        super().__init__()
+        self.amqp_connection = None
+        self.channel = None
+        self.tier_channels = {}
+        self.alert_exchange = None
+        self.db_pool = None
+        self.lanes = [Lane(index) for index in range(ASYNC_LANES)]
+        self.commit_slots = asyncio.Semaphore(ASYNC_MAX_INFLIGHT_COMMITS)
+        # Delivery tags are per channel, so each tier settles through its own tracker
+        self.acks = {tier: AckTracker() for tier in TIERS}
+        self.symbol_ids: Dict[str, int] = {}
+        self.tasks = set()
+
+    async def setup_amqp(self):
+        """Connect to RabbitMQ and declare the queues and alert exchange"""
+        try:
+            self.amqp_connection = await aio_pika.connect_robust(
+                host=RABBITMQ_HOST,
+                port=RABBITMQ_PORT,
+                login=RABBITMQ_USER,
+                password=RABBITMQ_PASS,
+                heartbeat=600
+            )
+            self.channel = await self.amqp_connection.channel()
+            self.alert_exchange = await self.channel.declare_exchange(
+                ALERT_EXCHANGE,
+                aio_pika.ExchangeType.TOPIC,
+                durable=True
+            )
+            logging.info("Connected to RabbitMQ (async)")
+
+        except Exception as e:
+            logging.error(f"Failed to connect to RabbitMQ: {e}")
+            raise
+
+    async def setup_db_pool(self):
+        """Open the asyncpg pool used for quote inserts"""
+        try:
+            self.db_pool = await asyncpg.create_pool(
+                get_database_url(),
+                min_size=1,
+                max_size=ASYNC_DB_POOL_SIZE
+            )
+            logging.info(f"Opened asyncpg pool with up to {ASYNC_DB_POOL_SIZE} connections")
+
+            # Warm the cache so known symbols never reach the registering insert
+            rows = await self.db_pool.fetch("SELECT symbol, id FROM symbols")
+            self.symbol_ids.update((row['symbol'], row['id']) for row in rows)
+            logging.info(f"Loaded {len(self.symbol_ids)} known symbols")
+
+        except Exception as e:
+            logging.error(f"Failed to open asyncpg pool: {e}")
+            raise
+
+    def spawn(self, coroutine):
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def get_symbol_id(self, connection, data: Dict[str, Any]) -> int:
+        """Get the dimension id for a symbol, registering it on first sight"""
+        symbol = data['symbol']
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id is None:
+            # Outside the data transaction so a rolled back insert never leaves a dangling cached id
+            symbol_id = await connection.fetchval(SELECT_SYMBOL_ID, symbol)
+            if symbol_id is None:
+                symbol_id = await connection.fetchval(INSERT_SYMBOL, symbol, data.get('name'), data.get('exchange'))
+            if symbol_id is None:
+                # Registered concurrently by another process
+                symbol_id = await connection.fetchval(SELECT_SYMBOL_ID, symbol)
+            self.symbol_ids[symbol] = symbol_id
+        return symbol_id
+
+    async def insert_batch(self, records: List[Dict[str, Any]]):
+        """Insert one lane's quotes in a single transaction"""
+        async with self.db_pool.acquire() as connection:
+            rows = []
+            for data in records:
+                rows.append((
+                    await self.get_symbol_id(connection, data),
+                    data['price'],
+                    data.get('change_percentage', 0.0),
+                    data.get('volume', 0),
+                    data.get('market_cap', 0.0),
+                    data['timestamp'],
+                    datetime.utcnow(),
+                    data.get('open'),
+                    data.get('high'),
+                    data.get('low'),
+                    data.get('previousClose')
+                ))
+            async with connection.transaction():
+                await connection.executemany(INSERT_STOCK_DATA, rows)
+
+    def flush_lane(self, lane: Lane):
+        """Start committing a lane's batch unless its previous commit is still running"""
+        if lane.batch and lane.commit is None:
+            batch, lane.batch = lane.batch, []
+            lane.commit = self.spawn(self.commit_batch(lane, batch))
+
+    async def settle_batch(self, batch, ack: bool = True, requeue: bool = False):
+        """Ack or nack a lane batch through the ack tracker of each tier in it"""
+        by_tier = defaultdict(list)
+        for tier, message, _ in batch:
+            by_tier[tier].append(message)
+        for tier, messages in by_tier.items():
+            if ack:
+                await self.acks[tier].ack(messages)
+            else:
+                await self.acks[tier].nack(messages, requeue=requeue)
+    
+    async def commit_batch(self, lane: Lane, batch):
+        """Insert a batch and settle its deliveries, spooling it while the database is down.
+
+        A batch that fails on a bad record is split in halves until the
+        record is isolated; the rest is stored and acked, and the record is
+        rejected without requeue. Nothing is requeued, so a lane's quotes
+        are never stored out of order.
+        """
+        # Chunks still to store, in delivery order
+        chunks = [batch]
+        try:
+            async with self.commit_slots:
+                while chunks:
+                    if self.is_spooling():
+                        # Spooled quotes are drained in order, so everything after them follows
+                        rest = [item for chunk in chunks for item in chunk]
+                        await self.spool_batch(rest)
+                        logging.info(f"Spooled batch of {len(rest)} records on lane {lane.index}")
+                        break
+
+                    chunk = chunks.pop(0)
+                    try:
+                        started = time.monotonic()
+                        await self.insert_batch([data for _, _, data in chunk])
+                        self.flow_controller.observe_commit(time.monotonic() - started, len(chunk))
+                    except Exception as e:
+                        if is_db_unavailable(e):
+                            logging.warning(f"Database write failed, spooling batch: {e}")
+                            self.set_db_available(False)
+                            chunks.insert(0, chunk)
+                        elif len(chunk) == 1:
+                            tier, message, data = chunk[0]
+                            logging.error(f"Rejecting record for {data['symbol']}: {e}")
+                            await self.acks[tier].nack([message], requeue=False)
+                        else:
+                            logging.error(f"Error processing batch of {len(chunk)} records, splitting it: {e}")
+                            middle = len(chunk) // 2
+                            chunks[:0] = [chunk[:middle], chunk[middle:]]
+                        continue
+
+                    await self.settle_batch(chunk)
+                    self.stored(chunk)
+                    logging.info(f"Processed batch of {len(chunk)} records on lane {lane.index}")
+
+        except Exception as e:
+            logging.error(f"Error committing batch on lane {lane.index}: {e}")
+        finally:
+            lane.commit = None
+            if len(lane.batch) >= self.flow_controller.batch_size:
+                self.flush_lane(lane)
+
+    async def spool_batch(self, batch):
+        """Append a batch to the local spool and fsync it, then ack it.
+
+        If the spool cannot be written the batch is retried in place; the
+        lane stays busy meanwhile, so its later quotes wait behind it.
+        """
+        records = [dict(data, timestamp=data['timestamp'].isoformat()) for _, _, data in batch]
+        while True:
+            try:
+                await asyncio.to_thread(self.write_spool, records)
+                break
+            except Exception as e:
+                logging.error(f"Failed to spool batch, retrying in {DB_RETRY_INTERVAL}s: {e}")
+                await asyncio.sleep(DB_RETRY_INTERVAL)
+        await self.settle_batch(batch)
+        self.stored(batch)
+
+    def write_spool(self, records: List[Dict[str, Any]]):
+        for record in records:
+            self.spool.append(record)
+        self.spool.sync()
+
+    def stored(self, batch):
+        """Evaluate alert rules on quotes once they are stored and acked.
+
+        Runs on the event loop, in lane order, so each symbol's quotes are
+        evaluated in order and a snapshot captured on the loop matches its marks.
+        """
+        alerts = []
+        for _, _, data in batch:
+            if self.high_water_mark is None or data['timestamp'] > self.high_water_mark:
+                self.high_water_mark = data['timestamp']
+            try:
+                alerts.extend(self.alert_engine.evaluate(data))
+            except Exception as e:
+                logging.error(f"Error evaluating alert rules for {data['symbol']}: {e}")
+        if alerts:
+            self.spawn(self.publish_alerts_async(alerts))
+
+    async def publish_alerts_async(self, alerts):
+        """Publish fired alerts to the alert exchange"""
+        for alert in alerts:
+            try:
+                await self.alert_exchange.publish(
+                    aio_pika.Message(
+                        body=json.dumps(alert).encode('utf-8'),
+                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                        content_type='application/json'
+                    ),
+                    routing_key=f"alert.{alert['symbol']}.{alert['rule_type']}"
+                )
+                logging.info(f"Alert {alert['rule_id']} fired for {alert['symbol']}: {alert['rule_type']} {alert['threshold']}")
+            except Exception as e:
+                logging.error(f"Failed to publish alert: {e}")
+
+    async def handle_message(self, message, tier: int = 1):
+        """Validate a quote and add it to its symbol's lane"""
+        self.acks[tier].track(message)
+        try:
+            data = enrich_stock_data(validate_stock_data(decode_message(message.body)))
+        except ValueError as e:
+            logging.error(f"Rejecting invalid message: {e}")
+            await self.acks[tier].nack([message], requeue=False)
+            return
+
+        lane = self.lanes[zlib.crc32(data['symbol'].encode('utf-8')) % len(self.lanes)]
+        if not lane.batch:
+            lane.batch_started = time.monotonic()
+        lane.batch.append((tier, message, data))
+        if len(lane.batch) >= self.flow_controller.batch_size:
+            self.flush_lane(lane)
+
+    async def handle_rule_message(self, message):
+        """Apply an alert rule command; persisting it uses the blocking database service"""
+        try:
+            await asyncio.to_thread(self.apply_rule_command, json.loads(message.body.decode('utf-8')))
+            await message.ack()
+
+        except (ValueError, KeyError, DataError, IntegrityError) as e:
+            # Retrying cannot fix a command the database rejects for its content
+            logging.error(f"Rejecting invalid alert rule command: {e}")
+            await message.nack(requeue=False)
+        except Exception as e:
+            logging.error(f"Error processing alert rule command: {e}")
+            # Requeue after a delay instead of spinning on it while the database is down
+            await asyncio.sleep(DB_RETRY_INTERVAL)
+            await message.nack(requeue=True)
+
+    def async_prefetch_count(self) -> int:
+        """Enough unacked quotes for every commit slot to have a full batch"""
+        if self.is_spooling():
+            return SPOOL_PREFETCH_COUNT
+        return min(FLOW_MAX_PREFETCH, self.flow_controller.prefetch_count * ASYNC_MAX_INFLIGHT_COMMITS)
+    
+    def tier_prefetch_count(self, tier: int) -> int:
+        """A tier's share of the prefetch window, in proportion to its weight"""
+        total_weight = sum(TIER_WEIGHTS.get(t, 1) for t in TIERS)
+        return max(1, self.prefetch_count * TIER_WEIGHTS.get(tier, 1) // total_weight)
+    
+    async def apply_prefetch_async(self):
+        """Apply the prefetch window, split by tier weight, when it changes"""
+        prefetch_count = self.async_prefetch_count()
+        if prefetch_count != self.prefetch_count:
+            self.prefetch_count = prefetch_count
+            for tier, channel in self.tier_channels.items():
+                await channel.set_qos(prefetch_count=self.tier_prefetch_count(tier))
+    
+    async def consume_tier(self, tier: int, queue):
+        """Consume one tier's queue; sequential iteration keeps delivery order for alerts and lanes"""
+        async with queue.iterator() as messages:
+            async for message in messages:
+                await self.handle_message(message, tier)
+
+    async def run_timer(self):
+        """Flush aged lanes, adjust flow control and save state snapshots"""
+        while True:
+            await asyncio.sleep(FLUSH_TICK)
+            try:
+                now = time.monotonic()
+                for lane in self.lanes:
+                    if lane.batch and now - lane.batch_started >= BATCH_MAX_WAIT:
+                        self.flush_lane(lane)
+
+                if now - self.last_depth_poll >= QUEUE_DEPTH_POLL_INTERVAL:
+                    self.last_depth_poll = now
+                    depth = 0
+                    for tier in TIERS:
+                        queue = await self.channel.declare_queue(tier_queue_name(QUEUE_NAME, tier), durable=True, passive=True)
+                        depth += queue.declaration_result.message_count
+                    self.flow_controller.observe_queue_depth(depth)
+
+                await self.apply_prefetch_async()
+
+                if now - self.last_snapshot >= STATE_SNAPSHOT_INTERVAL:
+                    # Captured on the event loop, where quotes are evaluated, and written off it
+                    await asyncio.to_thread(self.save_state_snapshot, self.capture_state())
+
+            except Exception as e:
+                logging.error(f"Error in flush timer: {e}")
+
+    def health(self) -> Dict[str, Any]:
+        """Processor state for the /health endpoint"""
+        connected = self.amqp_connection is not None and not self.amqp_connection.is_closed
+        return {
+            "status": "healthy" if connected else "unhealthy",
+            "mode": "async",
+            "rabbitmq_connected": connected,
+            "db_available": self.db_available,
+            "spooling": self.is_spooling() if self.spool else False,
+            "spool": self.spool.stats() if self.spool else None,
+            "flow_control": self.flow_controller.state(),
+            "db_pool": self.db_service.pool_stats() if self.db_service else None,
+            "async_db_pool": {
+                "size": self.db_pool.get_size(),
+                "idle": self.db_pool.get_idle_size(),
+                "max_size": self.db_pool.get_max_size()
+            } if self.db_pool else None,
+            "pending_batch": sum(len(lane.batch) for lane in self.lanes),
+            "inflight_commits": sum(1 for lane in self.lanes if lane.commit is not None),
+            "prefetch_count": self.prefetch_count,
+            "tier_prefetch_counts": {
+                f"tier{tier}": self.tier_prefetch_count(tier) for tier in TIERS
+            } if self.prefetch_count else None,
+            "state_high_water_mark": self.high_water_mark.isoformat() if self.high_water_mark else None,
+            "timestamp": datetime.now().isoformat()
+        }
+
+    async def consume(self):
+        """Set everything up and consume quotes until cancelled"""
+        try:
+            self.setup_database()
+            self.setup_alerts()
+            self.setup_state()
+            self.setup_spool()
+            await self.setup_db_pool()
+            await self.setup_amqp()
+
+            queues = {}
+            for tier in TIERS:
+                self.tier_channels[tier] = await self.amqp_connection.channel()
+                self.tier_channels[tier].reopen_callbacks.add(self.acks[tier].reset)
+                queues[tier] = await self.tier_channels[tier].declare_queue(tier_queue_name(QUEUE_NAME, tier), durable=True)
+            await self.apply_prefetch_async()
+
+            # Rule commands get their own channel so that multiple-acks of quotes never settle them
+            rules_channel = await self.amqp_connection.channel()
+            await rules_channel.set_qos(prefetch_count=1)
+            rules_queue = await rules_channel.declare_queue(ALERT_RULES_QUEUE, durable=True)
+            await rules_queue.consume(self.handle_rule_message)
+
+            self.spawn(self.run_timer())
+            self.setup_profiling()
+            self.health_server.start()
+
+            logging.info("Starting to consume messages from RabbitMQ (async)...")
+            await asyncio.gather(*(self.consume_tier(tier, queue) for tier, queue in queues.items()))
+
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        """Commit what is batched, then close connections"""
+        try:
+            self.health_server.stop()
+            for lane in self.lanes:
+                if lane.commit is not None:
+                    await lane.commit
+                self.flush_lane(lane)
+                if lane.commit is not None:
+                    await lane.commit
+            self.save_state_snapshot()
+            if self.spool_drainer:
+                self.spool_drainer.stop()
+                await asyncio.to_thread(self.spool_drainer.join, 10)
+            if self.spool:
+                self.spool.close()
+            if self.amqp_connection:
+                await self.amqp_connection.close()
+            if self.db_pool:
+                await self.db_pool.close()
+            if self.db_service:
+                self.db_service.dispose()
+            logging.info("Connections closed")
+        except Exception as e:
+            logging.error(f"Error during cleanup: {e}")
+
+    def start_processing(self):
+        """Start consuming messages from RabbitMQ"""
+        try:
+            asyncio.run(self.consume())
+        except KeyboardInterrupt:
+            logging.info("Stopping stream processor...")
+        except Exception as e:
+            logging.error(f"Error in stream processing: {e}")
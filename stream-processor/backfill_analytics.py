@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Backfill daily analytics for every symbol over a date range.
+
+Instead of one create_daily_analytics(symbol, date) round-trip per symbol
+and day, each chunk of days is computed for all symbols with a single
+set-based GROUP BY and upserted into stock_analytics. Chunks run in a
+process pool where every worker has its own engine. A chunk's results and
+its row in analytics_backfill_progress commit in the same transaction, so
+an interrupted backfill resumes from the first unfinished chunk:
+
+    python backfill_analytics.py --start 2024-01-01 --end 2025-01-01 --workers 4
+"""
+
+import argparse
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from sqlalchemy import text
+from models import create_engine_and_session
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+UPSERT_DAILY_ANALYTICS = text("""
+    INSERT INTO stock_analytics (
+        symbol, date, avg_price, min_price, max_price, price_volatility,
+        total_volume, price_change, percent_change, created_at
+    )
+    SELECT
+        s.symbol,
+        d.day,
+        d.avg_price,
+        d.min_price,
+        d.max_price,
+        coalesce(d.price_volatility, 0),
+        coalesce(d.total_volume, 0),
+        d.last_price - d.first_price,
+        CASE WHEN d.first_price <> 0
+             THEN (d.last_price - d.first_price) / d.first_price * 100
+        END,
+        now() AT TIME ZONE 'utc'
+    FROM (
+        SELECT
+            symbol_id,
+            date_trunc('day', timestamp) AS day,
+            avg(price) AS avg_price,
+            min(price) AS min_price,
+            max(price) AS max_price,
+            stddev(price) AS price_volatility,
+            sum(volume) AS total_volume,
+            (array_agg(price ORDER BY timestamp))[1] AS first_price,
+            (array_agg(price ORDER BY timestamp DESC))[1] AS last_price
+        FROM stock_data
+        WHERE timestamp >= :chunk_start AND timestamp < :chunk_end
+        GROUP BY symbol_id, date_trunc('day', timestamp)
+    ) d
+    JOIN symbols s ON s.id = d.symbol_id
+    ON CONFLICT ON CONSTRAINT uq_stock_analytics_symbol_date DO UPDATE SET
+        avg_price = EXCLUDED.avg_price,
+        min_price = EXCLUDED.min_price,
+        max_price = EXCLUDED.max_price,
+        price_volatility = EXCLUDED.price_volatility,
+        total_volume = EXCLUDED.total_volume,
+        price_change = EXCLUDED.price_change,
+        percent_change = EXCLUDED.percent_change,
+        created_at = EXCLUDED.created_at
+""")
+
+RECORD_PROGRESS = text("""
+    INSERT INTO analytics_backfill_progress (chunk_start, chunk_end, rows_written, completed_at)
+    VALUES (:chunk_start, :chunk_end, :rows_written, now() AT TIME ZONE 'utc')
+    ON CONFLICT (chunk_start, chunk_end) DO UPDATE SET
+        rows_written = EXCLUDED.rows_written,
+        completed_at = EXCLUDED.completed_at
+""")
+
+COMPLETED_CHUNKS = text("""
+    SELECT chunk_start, chunk_end FROM analytics_backfill_progress
+    WHERE chunk_start >= :start AND chunk_end <= :end
+""")
+
+# Per-process engine, created by the pool initializer
+_engine = None
+
+def init_worker():
+    """Give each worker process its own single-connection engine"""
+    global _engine
+    # A chunk's GROUP BY can legitimately outlast the service statement timeout
+    _engine, _ = create_engine_and_session(pool_size=1, max_overflow=0, statement_timeout_ms=0)
+
+def backfill_chunk(chunk_start: datetime, chunk_end: datetime) -> Tuple[datetime, datetime, int, float]:
+    """Compute and upsert analytics for all symbols in one chunk of days"""
+    started = time.monotonic()
+    params = {'chunk_start': chunk_start, 'chunk_end': chunk_end}
+    with _engine.begin() as connection:
+        rows_written = connection.execute(UPSERT_DAILY_ANALYTICS, params).rowcount
+        connection.execute(RECORD_PROGRESS, dict(params, rows_written=rows_written))
+    return chunk_start, chunk_end, rows_written, time.monotonic() - started
+
+def build_chunks(start: datetime, end: datetime, chunk_days: int) -> List[Tuple[datetime, datetime]]:
+    """Split [start, end) into chunks of whole days"""
+    chunks = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days), end)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+def pending_chunks(chunks: List[Tuple[datetime, datetime]], start: datetime,
+                   end: datetime) -> List[Tuple[datetime, datetime]]:
+    """Drop chunks already recorded in the progress table"""
+    engine, _ = create_engine_and_session()
+    try:
+        with engine.connect() as connection:
+            completed = {
+                (row.chunk_start, row.chunk_end)
+                for row in connection.execute(COMPLETED_CHUNKS, {'start': start, 'end': end})
+            }
+    finally:
+        engine.dispose()
+    return [chunk for chunk in chunks if chunk not in completed]
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m-%d')
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Backfill daily stock analytics for all symbols")
+    parser.add_argument('--start', type=parse_date, required=True, help="First day, YYYY-MM-DD")
+    parser.add_argument('--end', type=parse_date, required=True, help="Day after the last day, YYYY-MM-DD")
+    parser.add_argument('--chunk-days', type=int, default=7, help="Days per chunk")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Worker processes")
+    parser.add_argument('--force', action='store_true', help="Recompute chunks that already completed")
+    args = parser.parse_args()
+
+    if args.end <= args.start:
+        parser.error("--end must be after --start")
+
+    chunks = build_chunks(args.start, args.end, args.chunk_days)
+    if not args.force:
+        remaining = pending_chunks(chunks, args.start, args.end)
+        if len(remaining) < len(chunks):
+            logging.info(f"Resuming: {len(chunks) - len(remaining)} of {len(chunks)} chunks already done")
+        chunks = remaining
+
+    if not chunks:
+        logging.info("Nothing to backfill")
+        return
+
+    logging.info(f"Backfilling {len(chunks)} chunks with {args.workers} workers")
+    started = time.monotonic()
+    total_rows = 0
+    failed = 0
+
+    # spawn so that no worker inherits a parent connection
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=init_worker) as executor:
+        futures = {
+            executor.submit(backfill_chunk, chunk_start, chunk_end): (chunk_start, chunk_end)
+            for chunk_start, chunk_end in chunks
+        }
+        for future in as_completed(futures):
+            chunk_start, chunk_end = futures[future]
+            try:
+                _, _, rows_written, elapsed = future.result()
+                total_rows += rows_written
+                logging.info(f"Chunk {chunk_start.date()} - {chunk_end.date()}: {rows_written} rows in {elapsed:.2f}s")
+            except Exception as e:
+                failed += 1
+                logging.error(f"Chunk {chunk_start.date()} - {chunk_end.date()} failed: {e}")
+
+    logging.info(
+        f"Backfill finished: {total_rows} rows in {time.monotonic() - started:.2f}s, "
+        f"{failed} chunk(s) failed"
+    )
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,40 +2,107 @@
 
 import logging
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
-from models import StockData, StockAnalytics, create_engine_and_session
+from sqlalchemy import func, desc, insert, select, text, values, column, String, DateTime, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import Symbol, StockData, StockAnalytics, PriceAlertRule, create_engine_and_session
 
 class DatabaseService:
     """Service class for database operations using SQLAlchemy"""
     
     def __init__(self):
         self.engine, self.SessionLocal = create_engine_and_session()
+        # symbol -> symbols.id, symbols are never renumbered so this never goes stale
+        self.symbol_ids: Dict[str, int] = {}
     
     def get_session(self) -> Session:
         """Get a new database session"""
         return self.SessionLocal()
     
+    def load_symbol_ids(self) -> int:
+        """Fill the symbol id cache with every registered symbol"""
+        session = self.get_session()
+        try:
+            self.symbol_ids.update(session.execute(select(Symbol.symbol, Symbol.id)).tuples())
+            return len(self.symbol_ids)
+            
+        except Exception as e:
+            logging.error(f"Error loading symbols: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def get_symbol_id(self, symbol: str, company_name: Optional[str] = None,
+                      exchange: Optional[str] = None) -> int:
+        """Get the dimension id for a symbol, registering it on first sight"""
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id is not None:
+            return symbol_id
+        
+        # Committed on its own so a rolled back data insert never leaves a dangling cached id
+        session = self.get_session()
+        try:
+            # Looked up first: an INSERT takes a value from the smallint id sequence even on conflict
+            lookup = select(Symbol.id).where(Symbol.symbol == symbol)
+            symbol_id = session.execute(lookup).scalar()
+            if symbol_id is None:
+                stmt = pg_insert(Symbol).values(
+                    symbol=symbol,
+                    company_name=company_name,
+                    exchange=exchange
+                ).on_conflict_do_nothing(index_elements=[Symbol.symbol]).returning(Symbol.id)
+                symbol_id = session.execute(stmt).scalar()
+                if symbol_id is None:
+                    # Registered concurrently by another process
+                    symbol_id = session.execute(lookup).scalar_one()
+                session.commit()
+            
+            self.symbol_ids[symbol] = symbol_id
+            return symbol_id
+            
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error registering symbol {symbol}: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def lookup_symbol_id(self, session: Session, symbol: str) -> Optional[int]:
+        """Get the dimension id for a symbol without registering it"""
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = session.query(Symbol.id).filter(Symbol.symbol == symbol).scalar()
+            if symbol_id is not None:
+                self.symbol_ids[symbol] = symbol_id
+        return symbol_id
+    
+    def build_stock_data_row(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Map a quote message onto stock_data column values"""
+        symbol_id = self.get_symbol_id(
+            data.get('symbol'),
+            company_name=data.get('name'),
+            exchange=data.get('exchange')
+        )
+        return {
+            'symbol_id': symbol_id,
+            'price': data.get('price', 0.0),
+            'change_percentage': data.get('change_percentage', 0.0),
+            'volume': data.get('volume', 0),
+            'market_cap': data.get('market_cap', 0.0),
+            'timestamp': data.get('timestamp', datetime.utcnow()),
+            'processed_at': datetime.utcnow(),
+            'open_price': data.get('open'),
+            'high_price': data.get('high'),
+            'low_price': data.get('low'),
+            'previous_close': data.get('previousClose')
+        }
+    
     def add_stock_data(self, data: Dict[str, Any]) -> StockData:
         """Add stock data to the database"""
         session = self.get_session()
         try:
-            stock_data = StockData(
-                symbol=data.get('symbol'),
-                price=data.get('price', 0.0),
-                change_percentage=data.get('change_percentage', 0.0),
-                volume=data.get('volume', 0),
-                market_cap=data.get('market_cap', 0.0),
-                timestamp=data.get('timestamp', datetime.utcnow()),
-                processed_at=datetime.utcnow(),
-                open_price=data.get('open'),
-                high_price=data.get('high'),
-                low_price=data.get('low'),
-                previous_close=data.get('previousClose'),
-                exchange=data.get('exchange'),
-                company_name=data.get('name')
-            )
+            stock_data = StockData(**self.build_stock_data_row(data))
             
             session.add(stock_data)
             session.commit()
@@ -51,13 +118,41 @@ class DatabaseService:
         finally:
             session.close()
     
+    def bulk_add_stock_data(self, records: List[Dict[str, Any]]) -> int:
+        """Add many stock data records in a single transaction"""
+        if not records:
+            return 0
+        
+        session = self.get_session()
+        try:
+            rows = [self.build_stock_data_row(data) for data in records]
+            session.execute(insert(StockData), rows)
+            session.commit()
+            
+            logging.info(f"Added {len(rows)} stock data records")
+            return len(rows)
+            
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error bulk adding stock data: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def ping(self) -> bool:
+        """Check that the database accepts queries"""
+        with self.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        return True
+    
     def get_recent_stock_data(self, symbol: str, hours: int = 24) -> List[StockData]:
         """Get recent stock data for a symbol"""
         session = self.get_session()
         try:
             cutoff_time = datetime.utcnow() - timedelta(hours=hours)
+            symbol_id = self.lookup_symbol_id(session, symbol)
             data = session.query(StockData).filter(
-                StockData.symbol == symbol,
+                StockData.symbol_id == symbol_id,
                 StockData.timestamp >= cutoff_time
             ).order_by(desc(StockData.timestamp)).all()
             
@@ -69,11 +164,67 @@ class DatabaseService:
         finally:
             session.close()
     
+    def iter_stock_data_after(self, after: datetime, marks: Optional[Dict[str, datetime]] = None,
+                              batch_size: int = 5000) -> Iterator[Dict[str, Any]]:
+        """Stream quotes newer than a timestamp in time order.
+
+        With `marks`, a symbol listed there only streams quotes newer than its
+        own mark, and the scan starts at the oldest mark that still has newer
+        quotes; other symbols stream everything from there on.
+        """
+        session = self.get_session()
+        try:
+            marks_table = None
+            if marks:
+                marks_table = values(
+                    column('symbol', String), column('mark', DateTime), name='marks'
+                ).data(list(marks.items()))
+                # Symbols with nothing newer, e.g. delisted ones, must not hold the scan back
+                newer = select(StockData.id).join(
+                    Symbol, Symbol.id == StockData.symbol_id
+                ).where(
+                    Symbol.symbol == marks_table.c.symbol,
+                    StockData.timestamp > marks_table.c.mark
+                ).exists()
+                oldest = session.execute(select(func.min(marks_table.c.mark)).where(newer)).scalar()
+                if oldest is not None:
+                    after = min(after, oldest)
+            
+            query = select(
+                Symbol.symbol,
+                StockData.price,
+                StockData.change_percentage,
+                StockData.volume,
+                StockData.timestamp
+            ).join(
+                Symbol, Symbol.id == StockData.symbol_id
+            ).where(
+                StockData.timestamp > after
+            ).order_by(
+                StockData.timestamp, StockData.id
+            ).execution_options(yield_per=batch_size)
+            if marks_table is not None:
+                query = query.outerjoin(
+                    marks_table, marks_table.c.symbol == Symbol.symbol
+                ).where(
+                    or_(marks_table.c.mark.is_(None), StockData.timestamp > marks_table.c.mark)
+                )
+            
+            for row in session.execute(query):
+                yield row._asdict()
+            
+        except Exception as e:
+            logging.error(f"Error streaming stock data: {e}")
+            raise
+        finally:
+            session.close()
+    
     def get_stock_statistics(self, symbol: str, hours: int = 24) -> Dict[str, Any]:
         """Get stock statistics for a symbol"""
         session = self.get_session()
         try:
             cutoff_time = datetime.utcnow() - timedelta(hours=hours)
+            symbol_id = self.lookup_symbol_id(session, symbol)
             
             stats = session.query(
                 func.avg(StockData.price).label('avg_price'),
@@ -82,7 +233,7 @@ class DatabaseService:
                 func.stddev(StockData.price).label('price_volatility'),
                 func.sum(StockData.volume).label('total_volume')
             ).filter(
-                StockData.symbol == symbol,
+                StockData.symbol_id == symbol_id,
                 StockData.timestamp >= cutoff_time
             ).first()
             
@@ -118,6 +269,7 @@ class DatabaseService:
             # Get data for the specific date
             start_date = date.replace(hour=0, minute=0, second=0, microsecond=0)
             end_date = start_date + timedelta(days=1)
+            symbol_id = self.lookup_symbol_id(session, symbol)
             
             stats = session.query(
                 func.avg(StockData.price).label('avg_price'),
@@ -126,26 +278,36 @@ class DatabaseService:
                 func.stddev(StockData.price).label('price_volatility'),
                 func.sum(StockData.volume).label('total_volume')
             ).filter(
-                StockData.symbol == symbol,
+                StockData.symbol_id == symbol_id,
                 StockData.timestamp >= start_date,
                 StockData.timestamp < end_date
             ).first()
             
             if stats and stats.avg_price:
-                analytics = StockAnalytics(
-                    symbol=symbol,
-                    date=start_date,
-                    avg_price=float(stats.avg_price),
-                    min_price=float(stats.min_price) if stats.min_price else 0.0,
-                    max_price=float(stats.max_price) if stats.max_price else 0.0,
-                    price_volatility=float(stats.price_volatility) if stats.price_volatility else 0.0,
-                    total_volume=int(stats.total_volume) if stats.total_volume else 0,
-                    created_at=datetime.utcnow()
-                )
+                values = {
+                    'symbol': symbol,
+                    'date': start_date,
+                    'avg_price': float(stats.avg_price),
+                    'min_price': float(stats.min_price) if stats.min_price else 0.0,
+                    'max_price': float(stats.max_price) if stats.max_price else 0.0,
+                    'price_volatility': float(stats.price_volatility) if stats.price_volatility else 0.0,
+                    'total_volume': int(stats.total_volume) if stats.total_volume else 0,
+                    'created_at': datetime.utcnow()
+                }
                 
-                session.add(analytics)
+                # Recomputing a day replaces its row
+                stmt = pg_insert(StockAnalytics).values(**values)
+                stmt = stmt.on_conflict_do_update(
+                    constraint='uq_stock_analytics_symbol_date',
+                    set_={key: stmt.excluded[key] for key in values if key not in ('symbol', 'date')}
+                )
+                session.execute(stmt)
                 session.commit()
-                session.refresh(analytics)
+                
+                analytics = session.query(StockAnalytics).filter(
+                    StockAnalytics.symbol == symbol,
+                    StockAnalytics.date == start_date
+                ).one()
                 
                 logging.info(f"Created daily analytics for {symbol} on {start_date.date()}")
                 return analytics
@@ -164,7 +326,7 @@ class DatabaseService:
         """Get all unique symbols in the database"""
         session = self.get_session()
         try:
-            symbols = session.query(StockData.symbol).distinct().all()
+            symbols = session.query(Symbol.symbol).order_by(Symbol.symbol).all()
             return [symbol[0] for symbol in symbols]
             
         except Exception as e:
@@ -193,6 +355,85 @@ class DatabaseService:
         finally:
             session.close()
     
+    def get_alert_rules(self) -> List[PriceAlertRule]:
+        """Get all enabled alert rules"""
+        session = self.get_session()
+        try:
+            return session.query(PriceAlertRule).filter(
+                PriceAlertRule.enabled.is_(True)
+            ).all()
+            
+        except Exception as e:
+            logging.error(f"Error getting alert rules: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def save_alert_rules(self, rules: List[Dict[str, Any]]) -> int:
+        """Insert or replace alert rules"""
+        session = self.get_session()
+        try:
+            if not rules:
+                return 0
+            
+            rows = [{
+                'id': rule['rule_id'],
+                'symbol': rule['symbol'],
+                'rule_type': rule['rule_type'],
+                'threshold': rule['threshold'],
+                'cooldown_seconds': rule.get('cooldown_seconds', 300),
+                'enabled': True,
+                'created_at': datetime.utcnow()
+            } for rule in rules]
+            
+            # Chunk to stay well below the bind parameter limit
+            for start in range(0, len(rows), 1000):
+                stmt = pg_insert(PriceAlertRule).values(rows[start:start + 1000])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[PriceAlertRule.id],
+                    set_={
+                        'symbol': stmt.excluded.symbol,
+                        'rule_type': stmt.excluded.rule_type,
+                        'threshold': stmt.excluded.threshold,
+                        'cooldown_seconds': stmt.excluded.cooldown_seconds,
+                        'enabled': stmt.excluded.enabled
+                    }
+                )
+                session.execute(stmt)
+            
+            session.commit()
+            logging.info(f"Saved {len(rules)} alert rules")
+            return len(rules)
+            
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error saving alert rules: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def delete_alert_rule(self, rule_id: str) -> bool:
+        """Delete an alert rule"""
+        session = self.get_session()
+        try:
+            deleted_count = session.query(PriceAlertRule).filter(
+                PriceAlertRule.id == rule_id
+            ).delete()
+            
+            session.commit()
+            return deleted_count > 0
+            
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error deleting alert rule: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """Connection pool usage and checkout wait metrics"""
+        return self.engine.pool.metrics()
+    
     def dispose(self):
         """Dispose of the database engine"""
         if self.engine:
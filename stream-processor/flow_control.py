@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+from typing import Optional, Dict, Any
+
+class FlowController:
+    """Adaptive batch size and prefetch for the stream processor consumer.
+
+    Batch size follows AIMD on the observed commit latency: it grows by a
+    fixed step while commits are well under the target and a backlog is
+    waiting in the queue, and halves when commits get slower than the
+    target. Prefetch is kept at twice the batch size so the next batch can
+    fill while the current one commits.
+    """
+
+    def __init__(self, target_commit_latency: float = 0.05, min_batch_size: int = 1,
+                 max_batch_size: int = 500, initial_batch_size: int = 10,
+                 increase_step: int = 10, max_prefetch: int = 1000,
+                 backlog_threshold: int = 1000, latency_alpha: float = 0.3):
+        self.target_commit_latency = target_commit_latency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.increase_step = increase_step
+        self.max_prefetch = max_prefetch
+        self.backlog_threshold = backlog_threshold
+        self.latency_alpha = latency_alpha
+
+        self.batch_size = max(min_batch_size, min(initial_batch_size, max_batch_size))
+        self.commit_latency: Optional[float] = None
+        self.queue_depth: Optional[int] = None
+        self.commits = 0
+        self.committed_records = 0
+        self.lock = threading.Lock()
+
+    @property
+    def prefetch_count(self) -> int:
+        return max(1, min(self.batch_size * 2, self.max_prefetch))
+
+    @property
+    def backlogged(self) -> bool:
+        return self.queue_depth is not None and self.queue_depth >= self.backlog_threshold
+
+    def observe_queue_depth(self, depth: int):
+        """Record the ready-message count of the consumed queue"""
+        with self.lock:
+            self.queue_depth = depth
+
+    def observe_commit(self, latency: float, records: int):
+        """Record a committed batch and adapt the batch size"""
+        with self.lock:
+            self.commits += 1
+            self.committed_records += records
+            if self.commit_latency is None:
+                self.commit_latency = latency
+            else:
+                self.commit_latency += self.latency_alpha * (latency - self.commit_latency)
+
+            previous = self.batch_size
+            if self.commit_latency > self.target_commit_latency:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            elif (self.commit_latency < self.target_commit_latency / 2
+                  and records >= self.batch_size
+                  and (self.queue_depth or 0) > self.batch_size):
+                self.batch_size = min(self.max_batch_size, self.batch_size + self.increase_step)
+
+            if self.batch_size != previous:
+                logging.info(
+                    f"Batch size {previous} -> {self.batch_size} "
+                    f"(commit latency {self.commit_latency * 1000:.1f}ms, queue depth {self.queue_depth})"
+                )
+
+    def state(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'batch_size': self.batch_size,
+                'prefetch_count': self.prefetch_count,
+                'commit_latency_ms': round(self.commit_latency * 1000, 2) if self.commit_latency is not None else None,
+                'target_commit_latency_ms': round(self.target_commit_latency * 1000, 2),
+                'queue_depth': self.queue_depth,
+                'backlogged': self.backlogged,
+                'commits': self.commits,
+                'committed_records': self.committed_records
+            }
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from typing import Callable, Optional, Dict, Any
+
+class HealthServer:
+    """Minimal HTTP server exposing the stream processor state as JSON"""
+
+    def __init__(self, port: int, health: Callable[[], Dict[str, Any]]):
+        self.port = port
+        self.routes: Dict[str, Callable[[Dict[str, str]], Dict[str, Any]]] = {'/health': lambda query: health()}
+        # path -> token required as 'Authorization: Bearer <token>'
+        self.tokens: Dict[str, str] = {}
+        self.server = None
+        self.thread = None
+
+    def add_route(self, path: str, handler: Callable[[Dict[str, str]], Dict[str, Any]],
+                  token: Optional[str] = None):
+        """Serve handler(query parameters) at path; ValueError from it is a 400.
+
+        With a token, requests without 'Authorization: Bearer <token>' get a 401.
+        """
+        self.routes[path] = handler
+        if token:
+            self.tokens[path] = token
+
+    def start(self):
+        routes = self.routes
+        tokens = self.tokens
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                handler = routes.get(url.path)
+                if handler is None:
+                    self.send_error(404)
+                    return
+                token = tokens.get(url.path)
+                if token and not secrets.compare_digest(self.headers.get('Authorization', ''), f"Bearer {token}"):
+                    self.send_error(401)
+                    return
+                try:
+                    body = json.dumps(handler(dict(parse_qsl(url.query))), default=str).encode('utf-8')
+                    self.send_response(200)
+                except ValueError as e:
+                    body = json.dumps({'status': 'error', 'error': str(e)}).encode('utf-8')
+                    self.send_response(400)
+                except Exception as e:
+                    logging.error(f"Error serving {self.path}: {e}")
+                    body = json.dumps({'status': 'error', 'error': str(e)}).encode('utf-8')
+                    self.send_response(500)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('0.0.0.0', self.port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='health-server', daemon=True)
+        self.thread.start()
+        logging.info(f"Health endpoint listening on port {self.port}")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
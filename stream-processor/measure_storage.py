@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Measure stock_data size and insert rate.
+
+Run before and after `alembic upgrade head` to compare storage layouts:
+
+    python measure_storage.py --rows 20000
+
+Works against both the original wide layout and the compact symbol_id
+layout. Benchmark rows are inserted inside a transaction that is rolled
+back, so the table contents are left untouched (the id sequence does advance).
+"""
+
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List
+
+from sqlalchemy import text
+from models import create_engine_and_session
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+BENCHMARK_SYMBOL = 'ZZBENCH'
+
+LEGACY_INSERT = text(
+    "INSERT INTO stock_data (symbol, price, change_percentage, volume, market_cap, timestamp, "
+    "processed_at, open_price, high_price, low_price, previous_close, exchange, company_name) "
+    "VALUES (:symbol, :price, :change_percentage, :volume, :market_cap, :timestamp, "
+    ":processed_at, :open_price, :high_price, :low_price, :previous_close, :exchange, :company_name)"
+)
+
+COMPACT_INSERT = text(
+    "INSERT INTO stock_data (symbol_id, price, change_percentage, volume, market_cap, timestamp, "
+    "processed_at, open_price, high_price, low_price, previous_close) "
+    "VALUES (:symbol_id, :price, :change_percentage, :volume, :market_cap, :timestamp, "
+    ":processed_at, :open_price, :high_price, :low_price, :previous_close)"
+)
+
+def detect_layout(connection) -> str:
+    """Return 'compact' if stock_data references the symbols table"""
+    has_symbol_id = connection.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = 'stock_data' AND column_name = 'symbol_id'"
+    )).first()
+    return 'compact' if has_symbol_id else 'legacy'
+
+def measure_size(connection) -> Dict[str, Any]:
+    """Table, index and per-row sizes of stock_data"""
+    row = connection.execute(text(
+        "SELECT pg_total_relation_size('stock_data') AS total_bytes, "
+        "pg_relation_size('stock_data') AS heap_bytes, "
+        "pg_indexes_size('stock_data') AS index_bytes, "
+        "(SELECT count(*) FROM stock_data) AS row_count, "
+        "(SELECT coalesce(avg(pg_column_size(t.*)), 0) FROM stock_data t) AS avg_row_bytes"
+    )).one()
+    return {
+        'total_bytes': row.total_bytes,
+        'heap_bytes': row.heap_bytes,
+        'index_bytes': row.index_bytes,
+        'row_count': row.row_count,
+        'avg_row_bytes': float(row.avg_row_bytes)
+    }
+
+def build_rows(count: int, symbol_id: int = None) -> List[Dict[str, Any]]:
+    """Synthetic quotes, one second apart"""
+    start = datetime.utcnow()
+    rows = []
+    for i in range(count):
+        price = 100.0 + (i % 500) * 0.01
+        row = {
+            'price': price,
+            'change_percentage': 0.5,
+            'volume': 1000000 + i,
+            'market_cap': 2500000000000.0,
+            'timestamp': start + timedelta(seconds=i),
+            'processed_at': start,
+            'open_price': price - 1.0,
+            'high_price': price + 1.0,
+            'low_price': price - 2.0,
+            'previous_close': price - 0.5
+        }
+        if symbol_id is None:
+            row.update(symbol=BENCHMARK_SYMBOL, exchange='NASDAQ', company_name='Benchmark Holdings Incorporated')
+        else:
+            row['symbol_id'] = symbol_id
+        rows.append(row)
+    return rows
+
+def measure_insert_rate(engine, layout: str, count: int, batch_size: int) -> Dict[str, float]:
+    """Insert rows in batches inside a rolled back transaction"""
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            if layout == 'compact':
+                # Sequence values survive the rollback and symbols.id is a smallint,
+                # so reuse any registered symbol rather than inserting one per run
+                symbol_id = connection.execute(text(
+                    "SELECT id FROM symbols ORDER BY symbol = :symbol DESC, id LIMIT 1"
+                ), {'symbol': BENCHMARK_SYMBOL}).scalar()
+                if symbol_id is None:
+                    symbol_id = connection.execute(text(
+                        "INSERT INTO symbols (symbol, company_name, exchange) "
+                        "VALUES (:symbol, 'Benchmark Holdings Incorporated', 'NASDAQ') "
+                        "RETURNING id"
+                    ), {'symbol': BENCHMARK_SYMBOL}).scalar_one()
+                statement, rows = COMPACT_INSERT, build_rows(count, symbol_id)
+            else:
+                statement, rows = LEGACY_INSERT, build_rows(count)
+
+            started = time.perf_counter()
+            for start in range(0, len(rows), batch_size):
+                connection.execute(statement, rows[start:start + batch_size])
+            elapsed = max(time.perf_counter() - started, 1e-9)
+        finally:
+            transaction.rollback()
+
+    return {'rows': count, 'seconds': elapsed, 'rows_per_second': count / elapsed}
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Measure stock_data size and insert rate")
+    parser.add_argument('--rows', type=int, default=20000, help="Benchmark rows to insert")
+    parser.add_argument('--batch-size', type=int, default=500, help="Rows per executemany batch")
+    args = parser.parse_args()
+
+    engine, _ = create_engine_and_session()
+    try:
+        with engine.connect() as connection:
+            layout = detect_layout(connection)
+            size = measure_size(connection)
+
+        logging.info(
+            f"Layout: {layout}, total={size['total_bytes']} bytes, heap={size['heap_bytes']} bytes, "
+            f"indexes={size['index_bytes']} bytes, rows={size['row_count']}, avg_row={size['avg_row_bytes']:.1f} bytes"
+        )
+
+        rate = measure_insert_rate(engine, layout, args.rows, args.batch_size)
+        logging.info(f"Inserted {rate['rows']} rows in {rate['seconds']:.2f}s ({rate['rows_per_second']:.0f} rows/s)")
+    finally:
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
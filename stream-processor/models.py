@@ -1,47 +1,87 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Numeric, DateTime, Index
+from sqlalchemy import Column, Integer, SmallInteger, BigInteger, String, Numeric, Float, Double, DateTime, Boolean, Index, ForeignKey, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 import os
+import threading
+import time
+from typing import Dict, Any
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Connection pool and driver settings
+DB_DRIVER = 'postgresql+psycopg'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000'))
+DB_PREPARE_THRESHOLD = int(os.getenv('DB_PREPARE_THRESHOLD', '1'))
+DB_INSERTMANYVALUES_PAGE_SIZE = int(os.getenv('DB_INSERTMANYVALUES_PAGE_SIZE', '1000'))
+
 # Create base class for models
 Base = declarative_base()
 
+class Symbol(Base):
+    """SQLAlchemy model for the symbol dimension table"""
+    __tablename__ = 'symbols'
+    
+    id = Column(SmallInteger, primary_key=True, autoincrement=True)
+    symbol = Column(String(10), nullable=False)
+    company_name = Column(String(100))
+    exchange = Column(String(20))
+    
+    __table_args__ = (
+        UniqueConstraint('symbol', name='uq_symbols_symbol'),
+    )
+    
+    def __repr__(self):
+        return f"<Symbol(id={self.id}, symbol='{self.symbol}')>"
+
 class StockData(Base):
-    """SQLAlchemy model for stock data"""
+    """SQLAlchemy model for stock data
+    
+    Prices are stored as float8 and the symbol as a smallint reference into
+    the symbols table, which also holds the company name and exchange.
+    """
     __tablename__ = 'stock_data'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    symbol = Column(String(10), nullable=False, index=True)
-    price = Column(Numeric(10, 2), nullable=False)
-    change_percentage = Column(Numeric(5, 2))
+    symbol_id = Column(SmallInteger, ForeignKey('symbols.id', name='fk_stock_data_symbol_id'), nullable=False)
+    price = Column(Double, nullable=False)
+    change_percentage = Column(Double)
     volume = Column(Integer)
-    market_cap = Column(Numeric(20, 2))
-    timestamp = Column(DateTime, nullable=False, index=True)
+    market_cap = Column(Double)
+    timestamp = Column(DateTime, nullable=False)
     processed_at = Column(DateTime, default=datetime.utcnow)
     
     # Additional fields for enhanced analytics
-    open_price = Column(Numeric(10, 2))
-    high_price = Column(Numeric(10, 2))
-    low_price = Column(Numeric(10, 2))
-    previous_close = Column(Numeric(10, 2))
-    exchange = Column(String(20))
-    company_name = Column(String(100))
+    open_price = Column(Double)
+    high_price = Column(Double)
+    low_price = Column(Double)
+    previous_close = Column(Double)
+    
+    symbol_ref = relationship('Symbol', lazy='joined')
+    symbol = association_proxy('symbol_ref', 'symbol')
+    company_name = association_proxy('symbol_ref', 'company_name')
+    exchange = association_proxy('symbol_ref', 'exchange')
     
-    # Define composite index
+    # Per-symbol lookups use the composite B-tree, time range scans the BRIN index
     __table_args__ = (
-        Index('idx_stock_data_symbol_timestamp', 'symbol', 'timestamp'),
+        Index('idx_stock_data_symbol_id_timestamp', 'symbol_id', 'timestamp'),
+        Index('brin_stock_data_timestamp', 'timestamp', postgresql_using='brin'),
     )
     
     def __repr__(self):
-        return f"<StockData(symbol='{self.symbol}', price={self.price}, timestamp='{self.timestamp}')>"
+        return f"<StockData(symbol_id={self.symbol_id}, price={self.price}, timestamp='{self.timestamp}')>"
 
 class StockAnalytics(Base):
     """SQLAlchemy model for computed stock analytics"""
@@ -54,20 +94,87 @@ class StockAnalytics(Base):
     min_price = Column(Numeric(10, 2))
     max_price = Column(Numeric(10, 2))
     price_volatility = Column(Numeric(10, 4))
-    total_volume = Column(Integer)
+    total_volume = Column(BigInteger)
     price_change = Column(Numeric(10, 2))
-    percent_change = Column(Numeric(5, 2))
+    percent_change = Column(Numeric(10, 2))
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    # Define composite index
+    # One row per symbol and day, the target of analytics upserts
     __table_args__ = (
-        Index('idx_stock_analytics_symbol_date', 'symbol', 'date'),
+        UniqueConstraint('symbol', 'date', name='uq_stock_analytics_symbol_date'),
     )
     
     def __repr__(self):
         return f"<StockAnalytics(symbol='{self.symbol}', date='{self.date}', avg_price={self.avg_price})>"
 
-def get_database_url():
+class AnalyticsBackfillProgress(Base):
+    """SQLAlchemy model for completed analytics backfill chunks"""
+    __tablename__ = 'analytics_backfill_progress'
+    
+    chunk_start = Column(DateTime, primary_key=True)
+    chunk_end = Column(DateTime, primary_key=True)
+    rows_written = Column(Integer, nullable=False)
+    completed_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<AnalyticsBackfillProgress(chunk_start='{self.chunk_start}', chunk_end='{self.chunk_end}')>"
+
+class PriceAlertRule(Base):
+    """SQLAlchemy model for user-registered price alert rules"""
+    __tablename__ = 'alert_rules'
+    
+    id = Column(String(32), primary_key=True)
+    symbol = Column(String(10), nullable=False, index=True)
+    rule_type = Column(String(20), nullable=False)
+    threshold = Column(Float, nullable=False)
+    cooldown_seconds = Column(Integer, nullable=False, default=300)
+    enabled = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<PriceAlertRule(id='{self.id}', symbol='{self.symbol}', rule_type='{self.rule_type}', threshold={self.threshold})>"
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check out a connection"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+    
+    def connect(self):
+        started = time.monotonic()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            with self.metrics_lock:
+                self.checkout_timeouts += 1
+            raise
+        finally:
+            waited = time.monotonic() - started
+            with self.metrics_lock:
+                self.checkouts += 1
+                self.checkout_wait_total += waited
+                self.checkout_wait_max = max(self.checkout_wait_max, waited)
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Pool usage and checkout wait since the pool was created"""
+        with self.metrics_lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'checked_in': self.checkedin(),
+                'overflow': self.overflow(),
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.checkout_timeouts,
+                'checkout_wait_avg': self.checkout_wait_total / self.checkouts if self.checkouts else 0.0,
+                'checkout_wait_max': self.checkout_wait_max
+            }
+
+def get_database_url(driver: str = 'postgresql'):
     """Get database URL from environment variables"""
     host = os.getenv('POSTGRES_HOST', 'postgres')
     port = os.getenv('POSTGRES_PORT', '5432')
@@ -75,12 +182,48 @@ def get_database_url():
     user = os.getenv('POSTGRES_USER', 'fintech_user')
     password = os.getenv('POSTGRES_PASSWORD', 'fintech_pass')
     
-    return f"postgresql://{user}:{password}@{host}:{port}/{database}"
+    return f"{driver}://{user}:{password}@{host}:{port}/{database}"
+
+def build_engine(pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW,
+                 statement_timeout_ms: int = DB_STATEMENT_TIMEOUT_MS):
+    """Create an engine with the configured pool, timeouts and psycopg settings"""
+    return create_engine(
+        get_database_url(DB_DRIVER),
+        echo=False,
+        poolclass=InstrumentedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        # Plain executemany runs the prepared INSERT in psycopg pipeline mode;
+        # INSERT ... RETURNING batches are sent as multi-row VALUES pages
+        insertmanyvalues_page_size=DB_INSERTMANYVALUES_PAGE_SIZE,
+        connect_args={
+            'options': f"-c statement_timeout={statement_timeout_ms}",
+            # Server-side prepare statements once they have run this many times
+            'prepare_threshold': DB_PREPARE_THRESHOLD
+        }
+    )
+
+_shared_engine = None
+_shared_engine_lock = threading.Lock()
+
+def get_engine():
+    """Engine shared by everything in this process"""
+    global _shared_engine
+    with _shared_engine_lock:
+        if _shared_engine is None:
+            _shared_engine = build_engine()
+        return _shared_engine
+
+def create_engine_and_session(**engine_options):
+    """Create SQLAlchemy engine and session
 
-def create_engine_and_session():
-    """Create SQLAlchemy engine and session"""
-    database_url = get_database_url()
-    engine = create_engine(database_url, echo=False)
+    Without options the process-wide shared engine is used; options build a
+    dedicated engine (see build_engine).
+    """
+    engine = build_engine(**engine_options) if engine_options else get_engine()
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     return engine, SessionLocal
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Dict, Any, Callable
+
+# Marks the end of the stream on the stage queues
+STOP = object()
+
+class Envelope:
+    """A delivery travelling through the pipeline"""
+    __slots__ = ('channel', 'delivery_tag', 'body', 'data', 'error', 'requeue', 'received_at')
+
+    def __init__(self, channel, delivery_tag: int, body: bytes):
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+        self.body = body
+        self.data: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.requeue = False
+        # Delivery time, to report how long deliveries wait before each stage
+        self.received_at = time.monotonic()
+
+class Stage:
+    """One step of the processing pipeline.
+
+    process() transforms an envelope in place. Stages with parallel = True
+    run in the shared worker pool; their results are still handed on in
+    delivery order. The last stage is the sink: it receives failed
+    envelopes through reject() and is responsible for settling every
+    delivery. on_tick() is called periodically from the stage's thread.
+    The owning pipeline is available as self.pipeline once it is built.
+    """
+    name = 'stage'
+    parallel = False
+    pipeline = None
+
+    def process(self, envelope: Envelope):
+        pass
+
+    def reject(self, envelope: Envelope):
+        pass
+
+    def on_tick(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+def run_stage(stage: Stage, envelope: Envelope) -> Envelope:
+    """Run a stage, recording failures on the envelope instead of raising"""
+    try:
+        stage.process(envelope)
+    except ValueError as e:
+        # Bad message, retrying it cannot help
+        envelope.error = f"{stage.name}: {e}"
+        envelope.requeue = False
+    except Exception as e:
+        envelope.error = f"{stage.name}: {e}"
+        envelope.requeue = True
+    return envelope
+
+class StageRunner(threading.Thread):
+    """Thread feeding one stage from its inbound queue into the next one"""
+
+    def __init__(self, stage: Stage, inbound: queue.Queue, outbound: Optional[queue.Queue],
+                 executor: ThreadPoolExecutor, tick_interval: float):
+        super().__init__(name=f"stage-{stage.name}", daemon=True)
+        self.stage = stage
+        self.inbound = inbound
+        self.outbound = outbound
+        self.executor = executor
+        self.tick_interval = tick_interval
+        self.last_tick = time.monotonic()
+        self.processed = 0
+        # Seconds the last envelope waited between delivery and reaching this stage
+        self.last_wait = 0.0
+
+    def run(self):
+        while True:
+            try:
+                item = self.inbound.get(timeout=self.tick_interval)
+            except queue.Empty:
+                item = None
+
+            if item is STOP:
+                break
+            if item is not None:
+                # Futures from a parallel stage are resolved in the order they were queued
+                envelope = item.result() if isinstance(item, Future) else item
+                self.last_wait = time.monotonic() - envelope.received_at
+                self.handle(envelope)
+                self.processed += 1
+
+            if time.monotonic() - self.last_tick >= self.tick_interval:
+                self.last_tick = time.monotonic()
+                self.tick()
+
+        self.shutdown()
+
+    def handle(self, envelope: Envelope):
+        if self.outbound is None:
+            if envelope.error is not None:
+                self._call(self.stage.reject, envelope)
+            else:
+                run_stage(self.stage, envelope)
+                if envelope.error is not None:
+                    self._call(self.stage.reject, envelope)
+        elif envelope.error is not None:
+            self.outbound.put(envelope)
+        elif self.stage.parallel:
+            self.outbound.put(self.executor.submit(run_stage, self.stage, envelope))
+        else:
+            self.outbound.put(run_stage(self.stage, envelope))
+
+    def tick(self):
+        self._call(self.stage.on_tick)
+
+    def shutdown(self):
+        self._call(self.stage.close)
+        if self.outbound is not None:
+            self.outbound.put(STOP)
+
+    def _call(self, method: Callable, *args):
+        try:
+            method(*args)
+        except Exception as e:
+            logging.error(f"Error in pipeline stage {self.stage.name}: {e}")
+
+class Pipeline:
+    """Stages connected by bounded queues, each driven by its own thread.
+
+    Deliveries are submitted from the pika connection thread; anything that
+    has to touch the channel again (acks, nacks, publishes) is marshalled
+    back onto that thread with add_callback_threadsafe.
+    """
+
+    def __init__(self, stages: List[Stage], connection, queue_size: int = 1000,
+                 workers: int = 4, tick_interval: float = 0.1, input_queue_size: Optional[int] = None):
+        self.stages = stages
+        self.connection = connection
+        for stage in stages:
+            stage.pipeline = self
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pipeline-worker')
+        # A small input queue makes submit() block early, keeping the backlog with the caller
+        self.queues = [queue.Queue(maxsize=input_queue_size or queue_size)]
+        self.queues.extend(queue.Queue(maxsize=queue_size) for _ in stages[1:])
+        self.runners = [
+            StageRunner(
+                stage,
+                self.queues[i],
+                self.queues[i + 1] if i + 1 < len(stages) else None,
+                self.executor,
+                tick_interval
+            )
+            for i, stage in enumerate(stages)
+        ]
+        self.closed = False
+
+    def start(self):
+        for runner in self.runners:
+            runner.start()
+        logging.info(f"Pipeline started: {' -> '.join(stage.name for stage in self.stages)}")
+
+    def submit(self, envelope: Envelope):
+        """Queue a delivery, blocking while the input queue is full"""
+        self.queues[0].put(envelope)
+
+    def call_on_connection(self, callback: Callable[[], None]):
+        """Run a callback on the connection thread"""
+        self.connection.add_callback_threadsafe(callback)
+
+    def settle(self, channel, delivery_tag: int, ack: bool = True, multiple: bool = False,
+               requeue: bool = False):
+        """Ack or nack a delivery from any thread"""
+        if ack:
+            callback = lambda: channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+        else:
+            callback = lambda: channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+        self.call_on_connection(callback)
+
+    def close(self, timeout: float = 30.0):
+        """Drain queued deliveries through every stage and stop the threads"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queues[0].put(STOP)
+        deadline = time.monotonic() + timeout
+        for runner in self.runners:
+            runner.join(timeout=max(deadline - time.monotonic(), 0))
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            runner.stage.name: dict(
+                runner.stage.stats(),
+                queued=self.queues[i].qsize(),
+                processed=runner.processed,
+                wait_ms=round(runner.last_wait * 1000, 1)
+            )
+            for i, runner in enumerate(self.runners)
+        }
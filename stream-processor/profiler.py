@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Low-overhead on-demand profiling for a live process.
+
+A background loop samples every thread's stack through sys._current_frames()
+and counts the collapsed stacks, which flamegraph.pl, speedscope or
+inferno read directly. On request tracemalloc runs for the same window and
+the allocation growth between its start and end is written alongside;
+it is off otherwise, since tracing slows down every allocation.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import List, Dict, Any, Tuple
+
+# Frames kept per allocation traceback while tracemalloc runs
+TRACEMALLOC_FRAMES = 10
+
+# Only one profile runs at a time in a process
+_profile_lock = threading.Lock()
+
+class ProfileInProgress(RuntimeError):
+    """Raised when a profile is requested while another one is running"""
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapse_stack(frame, thread_name: str) -> str:
+    """Render a stack root first, prefixed with its thread, in collapsed-stack form"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ';'.join(reversed(labels))
+
+def sample_stacks(duration: float, interval: float) -> Tuple[Counter, int]:
+    """Count the stacks of every other thread, sampled every interval seconds"""
+    own = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != own:
+                stacks[collapse_stack(frame, names.get(ident, f"thread-{ident}"))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def top_frames(stacks: Counter, limit: int) -> List[Tuple[str, int]]:
+    """Leaf frames with the most samples, i.e. where the time is spent itself"""
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    return leaves.most_common(limit)
+
+def run_profile(output_dir: str, duration: float, interval: float = 0.01,
+                memory: bool = False, limit: int = 20) -> Dict[str, Any]:
+    """Profile the process for duration seconds and write the results to output_dir.
+
+    Blocks the calling thread for the whole window, so call it from a
+    thread of its own rather than one that serves traffic.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfileInProgress("A profile is already running")
+
+    started_tracing = False
+    try:
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            started_tracing = True
+        before = tracemalloc.take_snapshot() if memory else None
+
+        started = time.monotonic()
+        stacks, samples = sample_stacks(duration, interval)
+        elapsed = time.monotonic() - started
+
+        os.makedirs(output_dir, exist_ok=True)
+        # Unique even for profiles finished within the same second
+        stamp = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        collapsed_path = os.path.join(output_dir, f"profile-{stamp}.collapsed")
+        with open(collapsed_path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        result = {
+            'collapsed': collapsed_path,
+            'duration': round(elapsed, 3),
+            'samples': samples,
+            'top_frames': top_frames(stacks, limit)
+        }
+
+        if memory:
+            # Leave the profiler's own allocations out of the report
+            ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+            after = tracemalloc.take_snapshot().filter_traces(ignore)
+            growth = after.compare_to(before.filter_traces(ignore), 'lineno')
+            memory_path = os.path.join(output_dir, f"memory-{stamp}.txt")
+            with open(memory_path, 'w') as f:
+                f.write(f"# Allocation growth over {elapsed:.1f}s\n")
+                f.writelines(f"{stat}\n" for stat in growth[:200])
+                f.write("\n# Largest live allocations\n")
+                f.writelines(f"{stat}\n" for stat in after.statistics('lineno')[:200])
+            result['memory'] = memory_path
+            result['top_allocations'] = [str(stat) for stat in growth[:limit]]
+
+        logging.info(f"Profile of {elapsed:.1f}s ({samples} samples) written to {collapsed_path}")
+        return result
+
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        _profile_lock.release()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Dict, Any, Tuple, Callable
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.jsonl'
+CHECKPOINT_FILE = 'checkpoint.json'
+REJECTS_FILE = 'rejects.jsonl'
+
+# (segment number, byte offset)
+Position = Tuple[int, int]
+
+class Spool:
+    """Append-only local spool of validated records, split into segment files.
+
+    Records are written as JSON lines and made durable in batches with fsync.
+    A checkpoint file records how far the spool has been drained; segments that
+    lie entirely before the checkpoint are deleted. After a crash the writer
+    starts a fresh segment, so a torn final line can only ever be the last
+    line of a segment that is no longer appended to, and the reader skips it.
+    Records the database refuses are moved to a rejects file.
+    """
+
+    def __init__(self, directory: str, segment_max_bytes: int = 64 * 1024 * 1024,
+                 fsync_batch_size: int = 200):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_batch_size = fsync_batch_size
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.checkpoint = self._load_checkpoint()
+
+        segments = self._list_segments()
+        next_segment = (segments[-1] + 1) if segments else max(self.checkpoint[0], 1)
+        if not segments or self.checkpoint[0] < segments[0]:
+            self.checkpoint = (segments[0] if segments else next_segment, 0)
+
+        self.write_segment = next_segment
+        self.write_file = open(self._segment_path(next_segment), 'ab')
+        self.write_position: Position = (next_segment, 0)
+        self.durable_position: Position = (next_segment, 0)
+        self.unsynced_count = 0
+        self.appended_count = 0
+        self.drained_count = 0
+        self.rejected_count = 0
+
+        if segments:
+            logging.info(f"Spool opened with {len(segments)} undrained segment(s) in {self.directory}")
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _list_segments(self) -> List[int]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _load_checkpoint(self) -> Position:
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            return (int(data['segment']), int(data['offset']))
+        except FileNotFoundError:
+            return (0, 0)
+
+    def _write_checkpoint(self, position: Position):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'segment': position[0], 'offset': position[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, record: Dict[str, Any]):
+        """Buffer a record; it is durable only after the next sync()"""
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self.lock:
+            self.write_file.write(line)
+            self.write_position = (self.write_segment, self.write_position[1] + len(line))
+            self.unsynced_count += 1
+            self.appended_count += 1
+
+            if self.write_position[1] >= self.segment_max_bytes:
+                self._sync()
+                self._rotate()
+
+    def needs_sync(self) -> bool:
+        return self.unsynced_count >= self.fsync_batch_size
+
+    def sync(self) -> int:
+        """fsync buffered records, returning how many became durable"""
+        with self.lock:
+            return self._sync()
+
+    def _sync(self) -> int:
+        if self.unsynced_count == 0:
+            return 0
+        self.write_file.flush()
+        os.fsync(self.write_file.fileno())
+        synced = self.unsynced_count
+        self.unsynced_count = 0
+        self.durable_position = self.write_position
+        return synced
+
+    def _rotate(self):
+        self.write_file.close()
+        self.write_segment += 1
+        self.write_file = open(self._segment_path(self.write_segment), 'ab')
+        self.write_position = (self.write_segment, 0)
+        self.durable_position = self.write_position
+        self._fsync_directory()
+
+    def is_empty(self) -> bool:
+        """True when every appended record has been drained"""
+        with self.lock:
+            return self.checkpoint >= self.write_position
+
+    def pending_bytes(self) -> int:
+        """Approximate number of undrained bytes"""
+        with self.lock:
+            if self.checkpoint[0] == self.write_position[0]:
+                return max(self.write_position[1] - self.checkpoint[1], 0)
+            total = 0
+            for segment in self._list_segments():
+                if segment < self.checkpoint[0]:
+                    continue
+                size = os.path.getsize(self._segment_path(segment))
+                total += size - (self.checkpoint[1] if segment == self.checkpoint[0] else 0)
+            return total
+
+    def read_batch(self, max_records: int) -> Tuple[List[Dict[str, Any]], List[Position], Position]:
+        """Read durable records from the checkpoint.
+
+        Returns the records, the position after each of them, and the
+        position after the whole batch (which may lie past the last record
+        when the batch ends on a segment boundary).
+        """
+        with self.lock:
+            durable = self.durable_position
+            segment, offset = self.checkpoint
+
+        records = []
+        ends = []
+        while len(records) < max_records and (segment, offset) < durable:
+            path = self._segment_path(segment)
+            if not os.path.exists(path):
+                segment, offset = self._next_segment(segment, durable)
+                continue
+
+            limit = durable[1] if segment == durable[0] else None
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while len(records) < max_records and (limit is None or offset < limit):
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        # End of segment, or a torn write left behind by a crash
+                        break
+                    offset += len(line)
+                    records.append(json.loads(line))
+                    ends.append((segment, offset))
+                else:
+                    return records, ends, (segment, offset)
+
+            if segment == durable[0]:
+                break
+            segment, offset = self._next_segment(segment, durable)
+
+        return records, ends, (segment, offset)
+
+    def _next_segment(self, segment: int, durable: Position) -> Position:
+        later = [s for s in self._list_segments() if s > segment]
+        return (later[0], 0) if later else durable
+
+    def commit(self, position: Position, count: int):
+        """Persist the drain checkpoint and delete fully drained segments"""
+        self._write_checkpoint(position)
+        with self.lock:
+            self.checkpoint = position
+            self.drained_count += count
+            drained_segments = [s for s in self._list_segments() if s < position[0]]
+
+        for segment in drained_segments:
+            try:
+                os.remove(self._segment_path(segment))
+            except FileNotFoundError:
+                pass
+
+    def reject(self, record: Dict[str, Any], error: Exception):
+        """Durably move a record the database refuses to the rejects file"""
+        line = json.dumps({
+            'record': record,
+            'error': str(error),
+            'rejected_at': time.time()
+        }, separators=(',', ':')).encode('utf-8') + b'\n'
+        with open(os.path.join(self.directory, REJECTS_FILE), 'ab') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock:
+            self.rejected_count += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'empty': self.is_empty(),
+            'pending_bytes': self.pending_bytes(),
+            'appended': self.appended_count,
+            'drained': self.drained_count,
+            'rejected': self.rejected_count
+        }
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.write_file.close()
+
+class SpoolDrainer(threading.Thread):
+    """Background thread that bulk-loads spooled records once the database is back.
+
+    `sink` receives batches in spool order and must raise on failure; the
+    checkpoint only advances after it returns, so a crash between the two
+    replays the batch (at-least-once). `probe` is polled while the database
+    is marked unavailable. A sink error `is_unavailable` does not put down
+    to an outage splits the batch until the offending record is isolated;
+    it goes to the rejects file and the checkpoint moves past it.
+    """
+
+    def __init__(self, spool: Spool, sink: Callable[[List[Dict[str, Any]]], None],
+                 probe: Callable[[], bool], is_available: Callable[[], bool],
+                 set_available: Callable[[bool], None], is_unavailable: Callable[[Exception], bool],
+                 batch_size: int = 500, retry_interval: float = 5.0):
+        super().__init__(name='spool-drainer', daemon=True)
+        self.spool = spool
+        self.sink = sink
+        self.probe = probe
+        self.is_available = is_available
+        self.set_available = set_available
+        self.is_unavailable = is_unavailable
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if self.spool.is_empty():
+                self.stop_event.wait(0.5)
+                continue
+
+            if not self.is_available():
+                if self._probe():
+                    logging.info("Database reachable again, draining spool")
+                    self.set_available(True)
+                else:
+                    self.stop_event.wait(self.retry_interval)
+                    continue
+
+            records, ends, position = self.spool.read_batch(self.batch_size)
+            if not records:
+                # Only unsynced records (or an empty segment hop) are left
+                if position > self.spool.checkpoint:
+                    self.spool.commit(position, 0)
+                self.stop_event.wait(0.1)
+                continue
+
+            try:
+                started = time.monotonic()
+                self.drain(records, ends, position)
+                logging.info(f"Drained {len(records)} spooled records in {time.monotonic() - started:.2f}s")
+            except Exception as e:
+                if self.is_unavailable(e):
+                    logging.warning(f"Database unavailable while draining spool: {e}")
+                    self.set_available(False)
+                else:
+                    logging.error(f"Error draining spool: {e}")
+                self.stop_event.wait(self.retry_interval)
+
+    def drain(self, records: List[Dict[str, Any]], ends: List[Position], position: Position):
+        """Store a batch, moving the checkpoint past each stored or rejected run; outages propagate"""
+        # (start, stop) index ranges still to store, in spool order
+        ranges = [(0, len(records))]
+        while ranges:
+            start, stop = ranges.pop(0)
+            end = ends[stop - 1] if stop < len(records) else position
+            try:
+                self.sink(records[start:stop])
+            except Exception as e:
+                if self.is_unavailable(e):
+                    raise
+                if stop - start > 1:
+                    logging.error(f"Error draining {stop - start} spooled records, splitting them: {e}")
+                    middle = (start + stop) // 2
+                    ranges[:0] = [(start, middle), (middle, stop)]
+                else:
+                    logging.error(f"Rejecting spooled record for {records[start].get('symbol')}: {e}")
+                    self.spool.reject(records[start], e)
+                    self.spool.commit(end, 0)
+                continue
+            self.spool.commit(end, stop - start)
+
+    def _probe(self) -> bool:
+        try:
+            return self.probe()
+        except Exception:
+            return False
+
+    def stop(self):
+        self.stop_event.set()
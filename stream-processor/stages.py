@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, Dict, Any, Callable, Tuple
+
+from sqlalchemy.exc import OperationalError, InterfaceError, DisconnectionError, TimeoutError as PoolTimeoutError
+from pipeline import Stage, Envelope
+
+# Errors meaning the database cannot take writes right now, as opposed to a bad record
+DB_UNAVAILABLE_ERRORS = (OperationalError, InterfaceError, DisconnectionError, PoolTimeoutError)
+
+# Limits of the symbols.symbol, symbols.company_name, symbols.exchange and stock_data.volume columns
+SYMBOL_MAX_LENGTH = 10
+NAME_MAX_LENGTH = 100
+EXCHANGE_MAX_LENGTH = 20
+VOLUME_MAX = 2 ** 31 - 1
+
+# Optional message fields stored in double precision columns
+NUMERIC_FIELDS = ('change_percentage', 'market_cap', 'open', 'high', 'low', 'previousClose')
+
+def decode_message(body: bytes) -> Dict[str, Any]:
+    """Decode a quote message, raising ValueError if it is not a JSON object"""
+    data = json.loads(body.decode('utf-8'))
+    if not isinstance(data, dict):
+        raise ValueError("Message is not a JSON object")
+    return data
+
+def validate_stock_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Check the fields against their columns and parse the timestamp, raising ValueError if unusable"""
+    symbol = data.get('symbol')
+    if not isinstance(symbol, str) or not symbol.strip():
+        raise ValueError("Message has no symbol")
+    if len(symbol.strip()) > SYMBOL_MAX_LENGTH:
+        raise ValueError(f"Symbol {symbol[:20]!r} is longer than {SYMBOL_MAX_LENGTH} characters")
+
+    price = data.get('price')
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        raise ValueError(f"Message for {symbol} has no numeric price")
+
+    volume = data.get('volume')
+    if volume is not None:
+        if isinstance(volume, bool) or not isinstance(volume, (int, float)):
+            raise ValueError(f"Message for {symbol} has a non-numeric volume")
+        if not 0 <= volume <= VOLUME_MAX:
+            raise ValueError(f"Volume {volume} for {symbol} is out of range")
+
+    for field in NUMERIC_FIELDS:
+        value = data.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"Message for {symbol} has a non-numeric {field}")
+
+    for field, max_length in (('name', NAME_MAX_LENGTH), ('exchange', EXCHANGE_MAX_LENGTH)):
+        value = data.get(field)
+        if value is not None and (not isinstance(value, str) or len(value) > max_length):
+            raise ValueError(f"Message for {symbol} has a {field} that is not a string of at most {max_length} characters")
+
+    # Parse timestamp
+    timestamp_str = data.get('timestamp')
+    if timestamp_str:
+        data['timestamp'] = datetime.fromisoformat(timestamp_str)
+    else:
+        data['timestamp'] = datetime.utcnow()
+
+    return data
+
+def enrich_stock_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Upper-case the symbol and coerce price and volume to their column types"""
+    data['symbol'] = data['symbol'].strip().upper()
+    data['price'] = float(data['price'])
+    if data.get('volume') is not None:
+        data['volume'] = int(data['volume'])
+    return data
+
+class DecodeStage(Stage):
+    """JSON-decode the message body"""
+    name = 'decode'
+    parallel = True
+
+    def process(self, envelope: Envelope):
+        envelope.data = decode_message(envelope.body)
+        envelope.body = None
+
+class ValidateStage(Stage):
+    """Reject quotes without a symbol or price and parse their timestamp"""
+    name = 'validate'
+    parallel = True
+
+    def process(self, envelope: Envelope):
+        validate_stock_data(envelope.data)
+
+class EnrichStage(Stage):
+    """Normalise the symbol and numeric fields before anything keys on them"""
+    name = 'enrich'
+    parallel = True
+
+    def process(self, envelope: Envelope):
+        enrich_stock_data(envelope.data)
+
+class AlertEvaluator:
+    """Evaluate alert rules on stored quotes and track the newest quote evaluated.
+
+    StorageSink calls it once quotes are committed or spooled and their
+    deliveries settled, so a batch that fails and comes back never fires
+    its alerts or moves the engine state twice. The sink runs on a single
+    thread, so every symbol's quotes are seen in order, though not across
+    symbols: the engine keeps the per-symbol marks replay relies on, and
+    `high_water_mark` is only the newest of them. `publish` must be safe
+    to call from that thread.
+    """
+
+    def __init__(self, alert_engine, publish: Callable[[List[Dict[str, Any]]], None],
+                 high_water_mark: Optional[datetime] = None):
+        self.alert_engine = alert_engine
+        self.publish = publish
+        self.high_water_mark = high_water_mark
+        self.fired = 0
+        # Held while quotes are evaluated, so a snapshot never sees state newer than its mark
+        self.lock = threading.Lock()
+
+    def evaluate(self, envelopes: List[Envelope]):
+        alerts = []
+        with self.lock:
+            for envelope in envelopes:
+                data = envelope.data
+                if self.high_water_mark is None or data['timestamp'] > self.high_water_mark:
+                    self.high_water_mark = data['timestamp']
+                alerts.extend(self.alert_engine.evaluate(data))
+
+        if alerts:
+            self.fired += len(alerts)
+            self.publish(alerts)
+
+    def snapshot(self) -> Tuple[Optional[datetime], Dict[str, Any]]:
+        """The high-water mark and the alert engine state it describes"""
+        with self.lock:
+            return self.high_water_mark, self.alert_engine.export_state()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'alerts_fired': self.fired}
+
+class StorageSink(Stage):
+    """Batch quotes into PostgreSQL, falling back to the local spool, and settle deliveries.
+
+    Each channel's deliveries reach the sink in order, so a batch or the
+    spooled run is settled with one multiple ack of the last delivery tag
+    per channel (there is a channel per symbol tier).
+    """
+    name = 'storage'
+
+    def __init__(self, db_service, spool, flow_controller, is_spooling: Callable[[], bool],
+                 set_db_available: Callable[[bool], None], batch_max_wait: float,
+                 on_stored: Optional[Callable[[List[Envelope]], None]] = None):
+        self.db_service = db_service
+        self.spool = spool
+        self.flow_controller = flow_controller
+        self.is_spooling = is_spooling
+        self.set_db_available = set_db_available
+        self.batch_max_wait = batch_max_wait
+        self.on_stored = on_stored
+        self.batch: List[Envelope] = []
+        self.batch_started = 0.0
+        # Spooled deliveries not yet acked
+        self.spool_pending: List[Envelope] = []
+
+    def process(self, envelope: Envelope):
+        if self.is_spooling():
+            # Anything still batched was received first and must be spooled first
+            for batched in self.batch:
+                self.spool_record(batched)
+            self.batch = []
+            self.spool_record(envelope)
+        else:
+            # Settle spooled deliveries before batch acks and nacks can cover them
+            if self.spool_pending:
+                self.flush_spool()
+
+            if not self.batch:
+                self.batch_started = time.monotonic()
+            self.batch.append(envelope)
+            if len(self.batch) >= self.flow_controller.batch_size:
+                self.flush_batch()
+
+    def reject(self, envelope: Envelope):
+        logging.error(f"Rejecting message: {envelope.error}")
+        self.pipeline.settle(envelope.channel, envelope.delivery_tag, ack=False, requeue=envelope.requeue)
+    
+    def settle_all(self, envelopes: List[Envelope], ack: bool = True, requeue: bool = False):
+        """Settle a run of deliveries with one multiple ack or nack per channel"""
+        last = OrderedDict((envelope.channel, envelope) for envelope in envelopes)
+        for channel, envelope in last.items():
+            self.pipeline.settle(channel, envelope.delivery_tag, ack=ack, multiple=True, requeue=requeue)
+
+    def spool_record(self, envelope: Envelope):
+        """Append a record to the spool; it is acked once the spool is fsynced"""
+        data = envelope.data
+        self.spool.append(dict(data, timestamp=data['timestamp'].isoformat()))
+        self.spool_pending.append(envelope)
+
+        if self.spool.needs_sync():
+            self.flush_spool()
+
+    def flush_spool(self):
+        """fsync the spool and ack every message it now holds"""
+        self.spool.sync()
+        if self.spool_pending:
+            pending, self.spool_pending = self.spool_pending, []
+            self.settle_all(pending)
+            self.stored(pending)
+
+    def flush_batch(self):
+        """Bulk insert the pending batch and ack it, spooling it if the database is down.
+
+        A batch that fails on a bad record is split in halves until the
+        record is isolated; the rest is stored and acked, and the record is
+        rejected without requeue (dead-lettered if the queue has a DLX).
+        """
+        if not self.batch:
+            return
+
+        # Chunks still to insert, in delivery order
+        chunks = [self.batch]
+        self.batch = []
+        while chunks:
+            chunk = chunks.pop(0)
+            try:
+                started = time.monotonic()
+                self.db_service.bulk_add_stock_data([envelope.data for envelope in chunk])
+                self.flow_controller.observe_commit(time.monotonic() - started, len(chunk))
+
+                self.settle_all(chunk)
+                self.stored(chunk)
+                logging.info(f"Processed batch of {len(chunk)} records")
+
+            except DB_UNAVAILABLE_ERRORS as e:
+                logging.warning(f"Database write failed, spooling batch: {e}")
+                self.set_db_available(False)
+                for envelope in chunk + [envelope for rest in chunks for envelope in rest]:
+                    self.spool_record(envelope)
+                return
+            except Exception as e:
+                if len(chunk) == 1:
+                    envelope = chunk[0]
+                    logging.error(f"Rejecting record for {envelope.data.get('symbol')}: {e}")
+                    self.pipeline.settle(envelope.channel, envelope.delivery_tag, ack=False, requeue=False)
+                else:
+                    logging.error(f"Error processing batch of {len(chunk)} records, splitting it: {e}")
+                    middle = len(chunk) // 2
+                    chunks[:0] = [chunk[:middle], chunk[middle:]]
+
+    def stored(self, envelopes: List[Envelope]):
+        """Hand settled records on; a failure there must not undo their storage"""
+        if self.on_stored is not None:
+            try:
+                self.on_stored(envelopes)
+            except Exception as e:
+                logging.error(f"Error handling stored records: {e}")
+
+    def on_tick(self):
+        if self.batch and time.monotonic() - self.batch_started >= self.batch_max_wait:
+            self.flush_batch()
+        self.flush_spool()
+
+    def close(self):
+        self.flush_batch()
+        self.flush_spool()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'pending_batch': len(self.batch)}
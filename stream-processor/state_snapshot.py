@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import logging
+import math
+import mmap
+import os
+import struct
+from typing import List, Optional, Dict, Tuple
+
+# File layout (little endian):
+#   header   magic 'PSNP', uint16 version, float64 high-water mark, uint32 table count
+#   table    name, uint32 row count, uint32 column count, row keys, column names,
+#            padding to 8 bytes, then one contiguous float64 array per column
+#   strings  are uint16 length + UTF-8 bytes; missing values are stored as NaN
+MAGIC = b'PSNP'
+VERSION = 1
+HEADER = struct.Struct('<4sHdI')
+TABLE_HEADER = struct.Struct('<II')
+STRING_LENGTH = struct.Struct('<H')
+
+# table name -> (row keys, column name -> values aligned with the keys)
+Table = Tuple[List[str], Dict[str, List[Optional[float]]]]
+
+def _pack_string(value: str) -> bytes:
+    encoded = value.encode('utf-8')
+    return STRING_LENGTH.pack(len(encoded)) + encoded
+
+def _unpack_string(buffer, offset: int) -> Tuple[str, int]:
+    (length,) = STRING_LENGTH.unpack_from(buffer, offset)
+    offset += STRING_LENGTH.size
+    return bytes(buffer[offset:offset + length]).decode('utf-8'), offset + length
+
+def write_snapshot(path: str, high_water_mark: float, tables: Dict[str, Table]):
+    """Atomically write a columnar snapshot of processor state"""
+    parts = [HEADER.pack(MAGIC, VERSION, high_water_mark, len(tables))]
+    size = len(parts[0])
+
+    for name, (keys, columns) in tables.items():
+        chunk = [_pack_string(name), TABLE_HEADER.pack(len(keys), len(columns))]
+        chunk.extend(_pack_string(key) for key in keys)
+        chunk.extend(_pack_string(column) for column in columns)
+        chunk_size = sum(len(part) for part in chunk)
+        chunk.append(b'\0' * (-(size + chunk_size) % 8))
+
+        for values in columns.values():
+            chunk.append(struct.pack(f'<{len(keys)}d', *(
+                math.nan if value is None else value for value in values
+            )))
+
+        parts.extend(chunk)
+        size += sum(len(part) for part in chunk)
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_snapshot(path: str) -> Optional[Tuple[float, Dict[str, Table]]]:
+    """Memory-map a snapshot, returning (high-water mark, tables) or None if there is none"""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        magic, version, high_water_mark, table_count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            logging.warning(f"Ignoring snapshot {path} with unknown format")
+            return None
+
+        offset = HEADER.size
+        tables = {}
+        view = memoryview(buffer)
+        try:
+            for _ in range(table_count):
+                name, offset = _unpack_string(buffer, offset)
+                row_count, column_count = TABLE_HEADER.unpack_from(buffer, offset)
+                offset += TABLE_HEADER.size
+
+                keys = []
+                for _ in range(row_count):
+                    key, offset = _unpack_string(buffer, offset)
+                    keys.append(key)
+                column_names = []
+                for _ in range(column_count):
+                    column, offset = _unpack_string(buffer, offset)
+                    column_names.append(column)
+                offset += -offset % 8
+
+                columns = {}
+                for column in column_names:
+                    array = view[offset:offset + 8 * row_count].cast('d')
+                    columns[column] = [None if math.isnan(value) else value for value in array]
+                    array.release()
+                    offset += 8 * row_count
+                tables[name] = (keys, columns)
+        finally:
+            view.release()
+
+    return high_water_mark, tables
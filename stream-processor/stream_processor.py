@@ -3,12 +3,26 @@
 import os
 import json
 import logging
-from datetime import datetime
-from typing import Dict, Any
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Optional, Dict, Any, Tuple
 
 import pika
 from dotenv import load_dotenv
+from sqlalchemy.exc import DataError, IntegrityError
 from database_service import DatabaseService
+from alert_engine import AlertEngine, AlertRule, EPOCH
+from spool import Spool, SpoolDrainer
+from flow_control import FlowController
+from health_server import HealthServer
+from state_snapshot import write_snapshot, read_snapshot
+from pipeline import Pipeline, Envelope
+from stages import DecodeStage, ValidateStage, EnrichStage, StorageSink, AlertEvaluator, DB_UNAVAILABLE_ERRORS
+from profiler import run_profile, ProfileInProgress
+from tiers import DeficitRoundRobin, parse_pairs, tier_queue_name
 
 # Load environment variables
 load_dotenv()
@@ -26,12 +40,74 @@ RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', '5672'))
 RABBITMQ_USER = os.getenv('RABBITMQ_USER', 'admin')
 RABBITMQ_PASS = os.getenv('RABBITMQ_PASS', 'admin123')
 QUEUE_NAME = os.getenv('QUEUE_NAME', 'stock_data_queue')
+ALERT_RULES_QUEUE = os.getenv('ALERT_RULES_QUEUE', 'alert_rules_queue')
+ALERT_EXCHANGE = os.getenv('ALERT_EXCHANGE', 'price_alerts')
+ALERT_DEBOUNCE_SECONDS = float(os.getenv('ALERT_DEBOUNCE_SECONDS', '30'))
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+SPOOL_SEGMENT_MAX_BYTES = int(os.getenv('SPOOL_SEGMENT_MAX_BYTES', str(64 * 1024 * 1024)))
+SPOOL_FSYNC_BATCH_SIZE = int(os.getenv('SPOOL_FSYNC_BATCH_SIZE', '200'))
+SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', '0.2'))
+SPOOL_PREFETCH_COUNT = int(os.getenv('SPOOL_PREFETCH_COUNT', '500'))
+SPOOL_DRAIN_BATCH_SIZE = int(os.getenv('SPOOL_DRAIN_BATCH_SIZE', '500'))
+DB_RETRY_INTERVAL = float(os.getenv('DB_RETRY_INTERVAL', '5'))
+BATCH_MAX_WAIT = float(os.getenv('BATCH_MAX_WAIT', '0.2'))
+FLOW_TARGET_COMMIT_LATENCY = float(os.getenv('FLOW_TARGET_COMMIT_LATENCY', '0.05'))
+FLOW_MIN_BATCH_SIZE = int(os.getenv('FLOW_MIN_BATCH_SIZE', '1'))
+FLOW_MAX_BATCH_SIZE = int(os.getenv('FLOW_MAX_BATCH_SIZE', '500'))
+FLOW_MAX_PREFETCH = int(os.getenv('FLOW_MAX_PREFETCH', '1000'))
+FLOW_BACKLOG_THRESHOLD = int(os.getenv('FLOW_BACKLOG_THRESHOLD', '1000'))
+QUEUE_DEPTH_POLL_INTERVAL = float(os.getenv('QUEUE_DEPTH_POLL_INTERVAL', '2'))
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '8001'))
+STATE_SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', 'state/processor_state.snap')
+STATE_SNAPSHOT_INTERVAL = float(os.getenv('STATE_SNAPSHOT_INTERVAL', '60'))
+PROCESSOR_MODE = os.getenv('PROCESSOR_MODE', 'blocking')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_DURATION = float(os.getenv('PROFILE_DURATION', '30'))
+PROFILE_MAX_DURATION = float(os.getenv('PROFILE_MAX_DURATION', '120'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '4'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', str(max(FLOW_MAX_PREFETCH, SPOOL_PREFETCH_COUNT))))
+SYMBOL_TIERS = {symbol: int(tier) for symbol, tier in parse_pairs(os.getenv('SYMBOL_TIERS', '')).items()}
+DEFAULT_SYMBOL_TIER = int(os.getenv('DEFAULT_SYMBOL_TIER', '1'))
+TIER_WEIGHTS = {int(tier): int(weight) for tier, weight in parse_pairs(os.getenv('TIER_WEIGHTS', '1:8,2:2,3:1')).items()}
+TIER_DISPATCH_WINDOW = int(os.getenv('TIER_DISPATCH_WINDOW', '100'))
+
+# Tier 1 is always consumed: its queue is the original QUEUE_NAME
+TIERS = sorted({1, DEFAULT_SYMBOL_TIER, *SYMBOL_TIERS.values()})
+
+# Period of the pipeline stage ticks (batch and spool flushes) and the connection-thread timer
+FLUSH_TICK = min(SPOOL_FSYNC_INTERVAL, BATCH_MAX_WAIT)
 
 class StreamProcessor:
     def __init__(self):
         self.rabbitmq_connection = None
         self.rabbitmq_channel = None
+        self.tier_channels = {}
+        self.rules_channel = None
         self.db_service = None
+        self.alert_engine = AlertEngine(debounce_seconds=ALERT_DEBOUNCE_SECONDS)
+        self.spool = None
+        self.spool_drainer = None
+        self.db_available = True
+        self.prefetch_count = None
+        self.pipeline = None
+        self.scheduler = DeficitRoundRobin({tier: TIER_WEIGHTS.get(tier, 1) for tier in TIERS})
+        self.dispatcher = None
+        self.dispatching = False
+        self.alert_evaluator = None
+        self.storage_sink = None
+        self.last_depth_poll = 0.0
+        self.flow_controller = FlowController(
+            target_commit_latency=FLOW_TARGET_COMMIT_LATENCY,
+            min_batch_size=FLOW_MIN_BATCH_SIZE,
+            max_batch_size=FLOW_MAX_BATCH_SIZE,
+            max_prefetch=FLOW_MAX_PREFETCH,
+            backlog_threshold=FLOW_BACKLOG_THRESHOLD
+        )
+        self.health_server = HealthServer(HEALTH_PORT, self.health)
+        self.high_water_mark: Optional[datetime] = None
+        self.last_snapshot = time.monotonic()
         
     def setup_rabbitmq(self):
         """Setup RabbitMQ connection and channel"""
@@ -47,10 +123,25 @@ class StreamProcessor:
             
             self.rabbitmq_connection = pika.BlockingConnection(parameters)
             self.rabbitmq_channel = self.rabbitmq_connection.channel()
+            # Each symbol tier and the rule commands get their own channel, so
+            # multiple-acks never cross them and every tier has its own prefetch
+            for tier in TIERS:
+                channel = self.rabbitmq_connection.channel()
+                channel.queue_declare(queue=tier_queue_name(QUEUE_NAME, tier), durable=True)
+                self.tier_channels[tier] = channel
+            self.rules_channel = self.rabbitmq_connection.channel()
             
-            # Declare queue
-            self.rabbitmq_channel.queue_declare(queue=QUEUE_NAME, durable=True)
-            logging.info(f"Connected to RabbitMQ and declared queue: {QUEUE_NAME}")
+            # Declare the rules queue and the exchange fired alerts are published to
+            self.rules_channel.queue_declare(queue=ALERT_RULES_QUEUE, durable=True)
+            self.rabbitmq_channel.exchange_declare(
+                exchange=ALERT_EXCHANGE,
+                exchange_type='topic',
+                durable=True
+            )
+            logging.info(
+                f"Connected to RabbitMQ and declared queues: "
+                f"{', '.join(tier_queue_name(QUEUE_NAME, tier) for tier in TIERS)}"
+            )
             
         except Exception as e:
             logging.error(f"Failed to connect to RabbitMQ: {e}")
@@ -61,36 +152,314 @@ class StreamProcessor:
         try:
             self.db_service = DatabaseService()
             logging.info("Connected to PostgreSQL database via SQLAlchemy")
+            logging.info(f"Loaded {self.db_service.load_symbol_ids()} known symbols")
             
         except Exception as e:
             logging.error(f"Failed to connect to PostgreSQL: {e}")
             raise
     
-    def process_message(self, ch, method, properties, body):
-        """Process incoming message from RabbitMQ using SQLAlchemy"""
+    def setup_spool(self):
+        """Open the local spool and start its background drainer"""
         try:
-            # Parse JSON message
-            data = json.loads(body.decode('utf-8'))
+            self.spool = Spool(
+                SPOOL_DIR,
+                segment_max_bytes=SPOOL_SEGMENT_MAX_BYTES,
+                fsync_batch_size=SPOOL_FSYNC_BATCH_SIZE
+            )
+            self.spool_drainer = SpoolDrainer(
+                self.spool,
+                sink=self.drain_spooled_records,
+                probe=self.db_service.ping,
+                is_available=lambda: self.db_available,
+                set_available=self.set_db_available,
+                is_unavailable=lambda error: isinstance(error, DB_UNAVAILABLE_ERRORS),
+                batch_size=SPOOL_DRAIN_BATCH_SIZE,
+                retry_interval=DB_RETRY_INTERVAL
+            )
+            self.spool_drainer.start()
+            logging.info(f"Local spool ready in {SPOOL_DIR}")
             
-            # Parse timestamp
-            timestamp_str = data.get('timestamp')
-            if timestamp_str:
-                data['timestamp'] = datetime.fromisoformat(timestamp_str)
-            else:
-                data['timestamp'] = datetime.utcnow()
+        except Exception as e:
+            logging.error(f"Failed to open spool: {e}")
+            raise
+    
+    def setup_pipeline(self):
+        """Build the decode -> validate -> enrich -> storage pipeline; alerts follow storage"""
+        self.alert_evaluator = AlertEvaluator(self.alert_engine, self.publish_alerts_threadsafe, self.high_water_mark)
+        self.storage_sink = StorageSink(
+            self.db_service,
+            self.spool,
+            self.flow_controller,
+            is_spooling=self.is_spooling,
+            set_db_available=self.set_db_available,
+            batch_max_wait=BATCH_MAX_WAIT,
+            on_stored=self.alert_evaluator.evaluate
+        )
+        self.pipeline = Pipeline(
+            [DecodeStage(), ValidateStage(), EnrichStage(), self.storage_sink],
+            self.rabbitmq_connection,
+            queue_size=PIPELINE_QUEUE_SIZE,
+            workers=PIPELINE_WORKERS,
+            tick_interval=FLUSH_TICK,
+            input_queue_size=TIER_DISPATCH_WINDOW
+        )
+        self.pipeline.start()
+        
+        self.dispatching = True
+        self.dispatcher = threading.Thread(target=self.dispatch_messages, name='tier-dispatcher', daemon=True)
+        self.dispatcher.start()
+    
+    def dispatch_messages(self):
+        """Feed deliveries into the pipeline in weighted fair order across tiers.
+        
+        The pipeline input queue holds only TIER_DISPATCH_WINDOW deliveries, so
+        backlogs wait in the scheduler where tier 1 can overtake them.
+        """
+        while True:
+            envelope = self.scheduler.pop(timeout=FLUSH_TICK)
+            if envelope is not None:
+                self.pipeline.submit(envelope)
+            elif not self.dispatching:
+                break
+    
+    def setup_profiling(self):
+        """Profile on SIGUSR1, or via GET /profile?duration=30&memory=true on the health port if PROFILE_TOKEN is set"""
+        if PROFILE_TOKEN:
+            self.health_server.add_route('/profile', self.profile_route, token=PROFILE_TOKEN)
+        signal.signal(signal.SIGUSR1, self.on_profile_signal)
+    
+    def profile(self, duration: float = PROFILE_DURATION, memory: bool = False) -> Dict[str, Any]:
+        """Sample all threads (and optionally allocations) for duration seconds, writing to PROFILE_DIR"""
+        return run_profile(PROFILE_DIR, duration, interval=PROFILE_INTERVAL, memory=memory)
+    
+    def profile_route(self, query: Dict[str, str]) -> Dict[str, Any]:
+        """Run a profile for the health server and return its summary"""
+        duration = float(query.get('duration', PROFILE_DURATION))
+        if not 0 < duration <= PROFILE_MAX_DURATION:
+            raise ValueError(f"duration must be between 0 and {PROFILE_MAX_DURATION} seconds")
+        try:
+            return self.profile(duration, memory=query.get('memory', 'false').lower() == 'true')
+        except ProfileInProgress as e:
+            return {"status": "busy", "error": str(e)}
+    
+    def on_profile_signal(self, signum, frame):
+        """SIGUSR1 handler: profile in the background so consumption carries on"""
+        threading.Thread(target=self.run_background_profile, name='profiler', daemon=True).start()
+    
+    def run_background_profile(self):
+        try:
+            self.profile()
+        except Exception as e:
+            logging.error(f"Profiling failed: {e}")
+    
+    def setup_alerts(self):
+        """Load persisted alert rules into the alert engine"""
+        try:
+            rules = [
+                AlertRule(
+                    rule_id=rule.id,
+                    symbol=rule.symbol,
+                    rule_type=rule.rule_type,
+                    threshold=rule.threshold,
+                    cooldown_seconds=rule.cooldown_seconds
+                )
+                for rule in self.db_service.get_alert_rules()
+            ]
+            self.alert_engine.load_rules(rules)
+            
+        except Exception as e:
+            logging.error(f"Failed to load alert rules: {e}")
+            raise
+    
+    def setup_state(self):
+        """Reload the state snapshot and replay only the rows each symbol's state lacks"""
+        try:
+            started = time.monotonic()
+            snapshot = read_snapshot(STATE_SNAPSHOT_PATH)
+            if snapshot is None:
+                logging.info("No state snapshot found, starting with empty state")
+                return
+            
+            high_water_mark, tables = snapshot
+            self.alert_engine.restore_state(tables)
+            self.high_water_mark = EPOCH + timedelta(seconds=high_water_mark)
             
-            # Add stock data to database
-            stock_data = self.db_service.add_stock_data(data)
+            # Tiers lag and async lanes commit out of order, so a symbol's state can
+            # be older than the snapshot mark; each symbol replays from its own mark
+            replayed = 0
+            marks = dict(self.alert_engine.high_water_marks)
+            for row in self.db_service.iter_stock_data_after(self.high_water_mark, marks):
+                self.alert_engine.evaluate(row, fire=False)
+                self.high_water_mark = max(self.high_water_mark, row['timestamp'])
+                replayed += 1
             
-            logging.info(f"Processed data for {stock_data.symbol}: Price=${stock_data.price}, Change={stock_data.change_percentage}%")
+            logging.info(
+                f"Restored state snapshot ({len(tables.get('alert_symbols', ([], {}))[0])} symbols) "
+                f"and replayed {replayed} newer rows in {time.monotonic() - started:.2f}s"
+            )
+            
+        except Exception as e:
+            logging.error(f"Failed to restore state snapshot, starting with empty state: {e}")
+    
+    def capture_state(self) -> Tuple[Optional[datetime], Dict[str, Any]]:
+        """The high-water mark and the alert engine state, taken together so they match"""
+        if self.alert_evaluator is not None:
+            return self.alert_evaluator.snapshot()
+        return self.high_water_mark, self.alert_engine.export_state()
+    
+    def save_state_snapshot(self, state: Optional[Tuple[Optional[datetime], Dict[str, Any]]] = None):
+        """Write processor state tagged with the newest quote timestamp it includes"""
+        high_water_mark, tables = state or self.capture_state()
+        if high_water_mark is None:
+            return
+        self.high_water_mark = high_water_mark
+        try:
+            started = time.monotonic()
+            write_snapshot(STATE_SNAPSHOT_PATH, (high_water_mark - EPOCH).total_seconds(), tables)
+            logging.info(f"Saved state snapshot at {self.high_water_mark.isoformat()} in {time.monotonic() - started:.3f}s")
             
-            # Acknowledge message
+        except Exception as e:
+            logging.error(f"Failed to save state snapshot: {e}")
+        finally:
+            self.last_snapshot = time.monotonic()
+    
+    def publish_alerts(self, alerts):
+        """Publish fired alerts to the alert exchange, runs on the connection thread"""
+        for alert in alerts:
+            try:
+                self.rabbitmq_channel.basic_publish(
+                    exchange=ALERT_EXCHANGE,
+                    routing_key=f"alert.{alert['symbol']}.{alert['rule_type']}",
+                    body=json.dumps(alert),
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                        content_type='application/json'
+                    )
+                )
+                logging.info(f"Alert {alert['rule_id']} fired for {alert['symbol']}: {alert['rule_type']} {alert['threshold']}")
+            except Exception as e:
+                logging.error(f"Failed to publish alert: {e}")
+    
+    def publish_alerts_threadsafe(self, alerts):
+        """Publish fired alerts from a pipeline thread"""
+        self.rabbitmq_connection.add_callback_threadsafe(partial(self.publish_alerts, alerts))
+    
+    def set_db_available(self, available: bool):
+        """Record whether the database is accepting writes"""
+        if available != self.db_available:
+            if available:
+                logging.info("Database marked available")
+            else:
+                logging.warning("Database marked unavailable, spooling records locally")
+        self.db_available = available
+    
+    def is_spooling(self) -> bool:
+        """Records go to the spool while the database is down or the spool still has a backlog"""
+        return not self.db_available or not self.spool.is_empty()
+    
+    def poll_queue_depth(self):
+        """Feed the ready-message count of all tier queues to the flow controller"""
+        depth = 0
+        for tier in TIERS:
+            result = self.rabbitmq_channel.queue_declare(queue=tier_queue_name(QUEUE_NAME, tier), durable=True, passive=True)
+            depth += result.method.message_count
+        self.flow_controller.observe_queue_depth(depth)
+    
+    def apply_prefetch(self):
+        """Apply the prefetch window for the current mode to every tier channel"""
+        prefetch_count = SPOOL_PREFETCH_COUNT if self.is_spooling() else self.flow_controller.prefetch_count
+        if prefetch_count != self.prefetch_count:
+            for channel in self.tier_channels.values():
+                channel.basic_qos(prefetch_count=prefetch_count)
+            self.prefetch_count = prefetch_count
+    
+    def on_flush_timer(self):
+        """Periodic flow control and state snapshots, runs on the connection thread"""
+        try:
+            now = time.monotonic()
+            if now - self.last_depth_poll >= QUEUE_DEPTH_POLL_INTERVAL:
+                self.last_depth_poll = now
+                self.poll_queue_depth()
+            self.apply_prefetch()
+            
+            if now - self.last_snapshot >= STATE_SNAPSHOT_INTERVAL:
+                self.save_state_snapshot()
+            
+        except Exception as e:
+            logging.error(f"Error in flush timer: {e}")
+        finally:
+            self.rabbitmq_connection.call_later(FLUSH_TICK, self.on_flush_timer)
+    
+    def health(self) -> Dict[str, Any]:
+        """Processor state for the /health endpoint"""
+        connected = self.rabbitmq_connection is not None and self.rabbitmq_connection.is_open
+        return {
+            "status": "healthy" if connected else "unhealthy",
+            "rabbitmq_connected": connected,
+            "db_available": self.db_available,
+            "spooling": self.is_spooling() if self.spool else False,
+            "spool": self.spool.stats() if self.spool else None,
+            "flow_control": self.flow_controller.state(),
+            "db_pool": self.db_service.pool_stats() if self.db_service else None,
+            "pending_batch": self.storage_sink.stats()['pending_batch'] if self.storage_sink else 0,
+            "pipeline": self.pipeline.stats() if self.pipeline else None,
+            "alerts": self.alert_evaluator.stats() if self.alert_evaluator else None,
+            "tiers": self.scheduler.stats(),
+            "prefetch_count": self.prefetch_count,
+            "state_high_water_mark": (
+                self.alert_evaluator.high_water_mark.isoformat()
+                if self.alert_evaluator and self.alert_evaluator.high_water_mark else None
+            ),
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    def drain_spooled_records(self, records):
+        """Bulk-load spooled records into PostgreSQL, called from the drainer thread"""
+        # Copied, as the drainer retries and rejects the records it passed in
+        self.db_service.bulk_add_stock_data([
+            dict(record, timestamp=datetime.fromisoformat(record['timestamp'])) for record in records
+        ])
+    
+    def process_message(self, ch, method, properties, body, tier: int = 1):
+        """Queue a quote delivery for the pipeline behind the other deliveries of its tier"""
+        self.scheduler.push(tier, Envelope(ch, method.delivery_tag, body))
+    
+    def apply_rule_command(self, command: Dict[str, Any]):
+        """Persist an alert rule command (add, bulk_add, remove) and apply it to the engine"""
+        action = command.get('action')
+        
+        if action in ('add', 'bulk_add'):
+            payloads = command.get('rules', [])
+            if action == 'add':
+                payloads = [command.get('rule', {})]
+            rules = [AlertRule.from_dict(payload) for payload in payloads]
+            self.db_service.save_alert_rules([rule.to_dict() for rule in rules])
+            self.alert_engine.load_rules(rules)
+        elif action == 'remove':
+            rule_id = command.get('rule_id')
+            self.db_service.delete_alert_rule(rule_id)
+            self.alert_engine.remove_rule(rule_id)
+            logging.info(f"Removed alert rule {rule_id}")
+        else:
+            raise ValueError(f"Unknown alert rule action: {action}")
+    
+    def process_rule_message(self, ch, method, properties, body):
+        """Apply an alert rule command from the producer API"""
+        try:
+            self.apply_rule_command(json.loads(body.decode('utf-8')))
             ch.basic_ack(delivery_tag=method.delivery_tag)
             
+        except (ValueError, KeyError, DataError, IntegrityError) as e:
+            # Retrying cannot fix a command the database rejects for its content
+            logging.error(f"Rejecting invalid alert rule command: {e}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         except Exception as e:
-            logging.error(f"Error processing message: {e}")
-            # Reject message and requeue
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            logging.error(f"Error processing alert rule command: {e}")
+            # Requeue after a delay instead of spinning on it while the database is down
+            self.rabbitmq_connection.call_later(
+                DB_RETRY_INTERVAL,
+                lambda: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            )
     
     def start_processing(self):
         """Start consuming messages from RabbitMQ"""
@@ -98,18 +467,33 @@ class StreamProcessor:
             # Setup connections
             self.setup_rabbitmq()
             self.setup_database()
+            self.setup_alerts()
+            self.setup_state()
+            self.setup_spool()
+            self.setup_pipeline()
+            self.setup_profiling()
             
             # Set QoS
-            self.rabbitmq_channel.basic_qos(prefetch_count=1)
+            self.apply_prefetch()
+            self.rules_channel.basic_qos(prefetch_count=1)
             
             # Start consuming
-            self.rabbitmq_channel.basic_consume(
-                queue=QUEUE_NAME,
-                on_message_callback=self.process_message
+            for tier, channel in self.tier_channels.items():
+                channel.basic_consume(
+                    queue=tier_queue_name(QUEUE_NAME, tier),
+                    on_message_callback=partial(self.process_message, tier=tier)
+                )
+            self.rules_channel.basic_consume(
+                queue=ALERT_RULES_QUEUE,
+                on_message_callback=self.process_rule_message
             )
+            self.rabbitmq_connection.call_later(FLUSH_TICK, self.on_flush_timer)
+            self.health_server.start()
             
             logging.info("Starting to consume messages from RabbitMQ...")
-            self.rabbitmq_channel.start_consuming()
+            # Dispatches deliveries of every channel on the connection
+            while True:
+                self.rabbitmq_connection.process_data_events(time_limit=None)
             
         except KeyboardInterrupt:
             logging.info("Stopping stream processor...")
@@ -121,7 +505,24 @@ class StreamProcessor:
     def cleanup(self):
         """Cleanup connections"""
         try:
-            if self.rabbitmq_connection:
+            if self.spool_drainer:
+                self.spool_drainer.stop()
+                self.spool_drainer.join(timeout=10)
+            self.health_server.stop()
+            if self.pipeline:
+                # Drain in-flight deliveries, then run the acks the stages queued for this thread
+                if self.rabbitmq_connection and self.rabbitmq_connection.is_open:
+                    for channel in self.tier_channels.values():
+                        channel.stop_consuming()
+                self.dispatching = False
+                self.dispatcher.join(timeout=30)
+                self.pipeline.close()
+                if self.rabbitmq_connection and self.rabbitmq_connection.is_open:
+                    self.rabbitmq_connection.process_data_events(time_limit=0)
+            self.save_state_snapshot()
+            if self.spool:
+                self.spool.close()
+            if self.rabbitmq_connection and self.rabbitmq_connection.is_open:
                 self.rabbitmq_connection.close()
             if self.db_service:
                 self.db_service.dispose()
@@ -131,7 +532,14 @@ class StreamProcessor:
 
 def main():
     """Main function"""
-    processor = StreamProcessor()
+    if PROCESSOR_MODE == 'async':
+        # Imported here so the blocking mode does not need the async drivers
+        from async_processor import AsyncStreamProcessor
+        processor = AsyncStreamProcessor()
+    elif PROCESSOR_MODE == 'blocking':
+        processor = StreamProcessor()
+    else:
+        raise SystemExit(f"Unknown PROCESSOR_MODE: {PROCESSOR_MODE}")
     processor.start_processing()
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import threading
+from collections import deque
+from typing import Dict, Optional, Any
+
+def parse_pairs(value: str) -> Dict[str, str]:
+    """Parse 'KEY:VALUE,KEY:VALUE' settings such as SYMBOL_TIERS and TIER_WEIGHTS"""
+    pairs = {}
+    for item in value.split(','):
+        if item.strip():
+            key, _, setting = item.partition(':')
+            pairs[key.strip()] = setting.strip()
+    return pairs
+
+def tier_queue_name(queue_name: str, tier: int) -> str:
+    """Tier 1 keeps the original queue, so untiered setups are unchanged"""
+    return queue_name if tier == 1 else f"{queue_name}_tier{tier}"
+
+class DeficitRoundRobin:
+    """Weighted fair scheduler over one FIFO per tier.
+
+    Tiers are visited round robin; a backlogged tier earns its weight in
+    credit on each visit and spends one credit per item, so under
+    contention each tier gets throughput in proportion to its weight while
+    an idle tier costs nothing. Items of a tier stay in arrival order.
+    """
+
+    def __init__(self, weights: Dict[int, int]):
+        self.weights = {tier: max(1, weight) for tier, weight in weights.items()}
+        self.order = sorted(self.weights)
+        self.queues = {tier: deque() for tier in self.order}
+        self.deficits = {tier: 0 for tier in self.order}
+        self.dispatched = {tier: 0 for tier in self.order}
+        # Start just before the first tier so it is the first one credited
+        self.position = len(self.order) - 1
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def push(self, tier: int, item: Any):
+        with self.condition:
+            self.queues[tier].append(item)
+            self.size += 1
+            self.condition.notify()
+
+    def pop(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """Next item by weighted fair order, or None if nothing arrived within timeout"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.size > 0, timeout):
+                return None
+
+            while True:
+                tier = self.order[self.position]
+                queue = self.queues[tier]
+                if queue and self.deficits[tier] > 0:
+                    self.deficits[tier] -= 1
+                    self.dispatched[tier] += 1
+                    self.size -= 1
+                    return queue.popleft()
+
+                # An emptied tier forfeits leftover credit; the next backlogged one earns its weight
+                if not queue:
+                    self.deficits[tier] = 0
+                self.position = (self.position + 1) % len(self.order)
+                next_tier = self.order[self.position]
+                if self.queues[next_tier]:
+                    self.deficits[next_tier] += self.weights[next_tier]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            return {
+                f"tier{tier}": {
+                    'weight': self.weights[tier],
+                    'queued': len(self.queues[tier]),
+                    'dispatched': self.dispatched[tier]
+                }
+                for tier in self.order
+            }